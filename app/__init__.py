@@ -1,42 +1,45 @@
-from app.models.table_models import User_2
+from library.startup_helper import StartupTimer
+
+startup = StartupTimer()  # started by the first import of the app package, see AppFactory.startup_report()
+
 # from sqla_stack.fl_sqla import sql_db
 from flask import Flask
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 
 flapp = Flask(__name__)
 # sql_db = SQLAlchemy(flapp)
 
 
-
-
-
 class AppFactory:
 
     @classmethod
     def create_app(cls, config=None, User2=None):
         try:
             from library.object_broker import ob
-            from flask import Flask
-            # flapp = Flask(__name__)
+            startup.mark('imports')
             ob['flapp'] = flapp
-            # sql_db = SQLAlchemy(flapp)
+            ob['startup'] = startup
 
             if config is None:
-                from config import Config
-                config = Config()
-
-            from app.api.api import api_blueprint
-            flapp.register_blueprint(
-                    api_blueprint)  # registering the api using blueprint. register here to activate the api
-
+                from config import Config  # noqa: F401 - registers the ob.config factory
+                config = ob.config  # built once per process, shared with the models and manage.py
             ob['config'] = config
+            startup.mark('config')
+
             flapp.config.from_object(config)
-            config.initialize(flapp, config)
+            config.initialize(flapp, config)  # a LAZY startup leaves the DB checks and connections to first use
+            startup.mark('initialize')
 
-            from app.api.api import api_blueprint
+            from app.api.api import api_blueprint, root_blueprint
             flapp.register_blueprint(
                 api_blueprint)  # registering the api using blueprint. register here to activate the api
+            flapp.register_blueprint(root_blueprint)
+            startup.mark('blueprints')
+
+            if config.STARTUP == 'EAGER':
+                config.warm_up(flapp)
+            else:  # the database itself is checked before its first engine is created, see DataBaseConfig
+                flapp.before_first_request(lambda: config.warm_up(flapp))
 
             # sql_db.init_app(flapp)  # here we are importing the db .. we use mysql and sqlalchemy
             # with flapp.app_context():
@@ -46,7 +49,15 @@ class AppFactory:
                 # are loaded in the future
 
             CORS(flapp)
+            startup.mark('cors')
             return flapp
 
         except Exception as e:
             raise e
+
+    @classmethod
+    def startup_report(cls):
+        """ms spent in each startup phase, from the first import of the app package"""
+        report = startup.report()
+        report['mode'] = flapp.config.get('STARTUP')
+        return report
@@ -1,11 +1,22 @@
 '''here the api file is written.. it can also be used for swagger the same api'''
-from flask import Blueprint
+import asyncio
+import io
+import json
 
+from flask import Blueprint, Response, request
+
+from app.models.base import BaseModel
+from app.models.table_models import User, User_2, models_by_name
+from app.service.importer import ModelImporter
 from library.api_tools import APIEndpoint
 from library.api_tools import APIClass
+from library.monitor.monitor import Monitor
 
 api_blueprint = Blueprint('int_api_bp', __name__, url_prefix='/api/v1')
+root_blueprint = Blueprint('root_bp', __name__)  # the routes outside /api/v1, e.g. /metrics for the scraper
 api_endpoint = APIEndpoint(api_blueprint)
+# cached responses are tagged with the tables they read, a write to a table drops them
+BaseModel.add_write_listener(lambda model: api_endpoint.invalidate_tag(model.__tablename__))
 
 
 class APIFlask(APIClass):
@@ -14,3 +25,96 @@ class APIFlask(APIClass):
     @api_endpoint.on_call()
     def home():
         return 'WELCOME TO FLASK APP & API'
+
+    @staticmethod
+    @api_endpoint.rule('/counts', methods=['GET'], cache={'ttl': 30, 'tags': ['User', 'User_2']})
+    @api_endpoint.on_call()
+    async def counts():
+        user_count, user_2_count = await asyncio.gather(User.count_async(), User_2.count_async())
+        return json.dumps({'user': user_count, 'user_2': user_2_count})
+
+    @staticmethod
+    @root_blueprint.route('/metrics', methods=['GET'])
+    @api_endpoint.on_call()
+    def metrics():
+        '''the request metrics of all the workers, in the Prometheus text format'''
+        return Response(Monitor.render(), status=200, headers={'content-type': 'text/plain; version=0.0.4'})
+
+
+class APIUser(APIClass):
+    '''listings are keyset paginated: pass the returned next_cursor back as cursor for the next page'''
+    page_args_schema = {
+        'type': 'object',
+        'properties': {'limit': {'type': 'integer', 'minimum': 1, 'maximum': APIEndpoint.max_page_limit}},
+    }
+
+    @staticmethod
+    @api_endpoint.rule('/users', params=[{'cursor': str}, {'limit': int}, {'name': str}, {'age': int}],
+                       validators={'args': page_args_schema}, methods=['GET'], cache={'ttl': 30, 'tags': ['User']})
+    @api_endpoint.on_call()
+    def users():
+        cursor, limit, name, age = api_endpoint.get_params('cursor', 'limit', 'name', 'age')
+        return api_endpoint.page_response(User, {'name': name, 'age': age}, cursor=cursor, limit=limit)
+
+    @staticmethod
+    @api_endpoint.rule('/users_2', params=[{'cursor': str}, {'limit': int}, {'name_2': str}, {'age_2': int},
+                                           {'user_key': int}], validators={'args': page_args_schema},
+                       methods=['GET'], cache={'ttl': 30, 'tags': ['User_2']})
+    @api_endpoint.on_call()
+    def users_2():
+        cursor, limit, name_2, age_2, user_key = api_endpoint.get_params(
+            'cursor', 'limit', 'name_2', 'age_2', 'user_key')
+        return api_endpoint.page_response(
+            User_2, {'name_2': name_2, 'age_2': age_2, 'user_key': user_key}, cursor=cursor, limit=limit)
+
+
+class APIExport(APIClass):
+    '''streamed exports, e.g. /export/user?format=csv&age=25. every declared column param is a filter'''
+
+    @staticmethod
+    @api_endpoint.rule('/export/<model>', params=[{'format': str}, {'pid': int}, {'name': str}, {'age': int},
+                                                  {'name_2': str}, {'age_2': int}, {'user_key': int}],
+                       methods=['GET'])
+    @api_endpoint.on_call()
+    def export(model):
+        if model not in models_by_name:
+            return Response(F'Unknown model: {model}. Expected one of {list(models_by_name)}', status=404)
+        model_cls = models_by_name[model]
+        args = api_endpoint.cast_args(request.args)
+        columns = {column.name for column in model_cls.__table__.columns}
+        filters = {key: value for key, value in args.items() if key in columns}
+        return api_endpoint.export_response(model_cls, filters, fmt=args.get('format', 'ndjson'))
+
+
+class APIImport(APIClass):
+    '''bulk import of a CSV / NDJSON upload (multipart "file", or the raw request body sent as text/csv or
+    application/x-ndjson) into a model. workers=0 (the default here) validates in the request process, at most
+    max_workers parsing processes can be asked for; the manage.py import command uses a full pool'''
+    max_workers = 2
+
+    @staticmethod
+    @api_endpoint.rule('/import/<model>', params=[{'format': str}, {'workers': int}, {'batch_size': int}],
+                       methods=['POST'])
+    @api_endpoint.on_call()
+    def import_rows(model):
+        if model not in models_by_name:
+            return Response(F'Unknown model: {model}. Expected one of {list(models_by_name)}', status=404)
+        fmt, workers, batch_size = api_endpoint.get_params('format', 'workers', 'batch_size')
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            if upload is None:
+                return Response('A multipart import needs a "file" part', status=400)
+            fmt = fmt or ('csv' if upload.filename.lower().endswith('.csv') else 'ndjson')
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+        else:
+            body_formats = {ctype: body_fmt for body_fmt, ctype in api_endpoint.export_content_types.items()}
+            if request.mimetype not in body_formats:
+                return Response(F'Unsupported content type: {request.mimetype}. Expected multipart/form-data or '
+                                F'one of {list(body_formats)}', status=400)
+            fmt = fmt or body_formats[request.mimetype]
+            stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')  # read as it is parsed
+
+        workers = min(max(workers or 0, 0), APIImport.max_workers)
+        importer = ModelImporter(models_by_name[model], batch_size=batch_size or 5000, workers=workers)
+        report = importer.import_stream(stream, fmt or 'ndjson')
+        return json.dumps(report, default=str)
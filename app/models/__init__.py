@@ -1,11 +1,18 @@
 '''getting the db cocnfigurations from yaml via config.py. written in init can be used anywhere in models'''
 
-from config import Config
-from sqlalchemy import MetaData, create_engine
+from library.config_helper import YAMLError
+from library.monitor.monitor import Monitor
+from library.object_broker import ob
+from library.startup_helper import StartupTimer
+from sqla_stack.fl_sqla import sql_db
+from sqla_stack.async_db import async_db
+from sqla_stack.pool import MonitoredQueuePool, prewarm
+from sqla_stack.profiler import sql_profiler
+from sqla_stack.replicas import replica_router
+from flask import has_app_context
+from sqlalchemy import orm
 from sqlalchemy_utils import database_exists, create_database
 
-config = Config()  # config class to config object
-
 
 class DataBaseConfig:
     DEBUG = False
@@ -19,9 +26,53 @@ class DataBaseConfig:
     db_host = None
     db_url = None
 
+    # pool configuration, each can be overridden per config mode in the yaml under <MODE>/POOL
+    pool_defaults = {
+        'POOL_SIZE': 5,
+        'MAX_OVERFLOW': 10,
+        'POOL_TIMEOUT': 30,  # seconds to wait for a connection before giving up
+        'POOL_RECYCLE': 280,  # seconds, below MySQL's wait_timeout, so idle connections never "go away"
+        'POOL_PRE_PING': True,
+        'PREWARM': 0,  # connections opened at startup
+    }
+    pool_config = None
+
+    # read replicas, under <MODE>/REPLICAS in the yaml: URLS (a list), STRATEGY, MAX_LAG, RETRY_AFTER
+    replica_defaults = {
+        'URLS': [],
+        'STRATEGY': 'round_robin',  # or least_loaded
+        'MAX_LAG': None,  # seconds, None to not check the replication lag
+        'RETRY_AFTER': 30,  # seconds a failed replica is left out
+        'HEALTH_INTERVAL': 10,  # seconds between health checks
+    }
+    replica_config = None
+
+    # per-request SQL profiling, under <MODE>/SQL_PROFILE in the yaml
+    profile_defaults = {
+        'ENABLED': True,
+        'SLOW_REQUEST_MS': 500,  # total statement time of a request reported as slow
+        'N_PLUS_ONE': 5,  # times a statement repeats in a request before it is reported as a suspected N+1
+        'DEBUG_HEADER': False,  # return each request's profile in the X-SQL-Profile header
+    }
+    profile_config = None
+
+    database_checked = False  # ensure_database() ran in this process
+
+    # the state of this worker's pool, set by export_pool_metrics before its metrics are written; the gauges
+    # of the live workers are summed at /metrics
+    pool_connections = Monitor.registry.gauge(
+        'db_pool_connections', 'Connections of the engine pool, by state (size, checked_in, checked_out, overflow).',
+        ('state',))
+    pool_checkouts = Monitor.registry.gauge(
+        'db_pool_checkouts', 'Connections checked out of the pool since the worker started.')
+    pool_timeouts = Monitor.registry.gauge(
+        'db_pool_checkout_timeouts', 'Checkouts that timed out waiting for a connection since the worker started.')
+    pool_wait = Monitor.registry.gauge(
+        'db_pool_checkout_wait_seconds', 'Time spent waiting for a pool connection since the worker started.')
+
     @classmethod  # initialzing the db using the sql alchemy uri
     def initialize(cls, flapp, config=None):
-        cls.config = config
+        cls.config = config or ob.config
         cls.config_mode = cls.config.config_mode
 
         cls.db_config()
@@ -31,20 +82,152 @@ class DataBaseConfig:
         flapp.config['SQLALCHEMY_BINDS'] = {
             "sql_db": cls.db_url,
         }
-
-        engine = create_engine(cls.db_url)
-        if not database_exists(engine.url):
-            create_database(engine.url)
+        flapp.config['SQLALCHEMY_ENGINE_OPTIONS'] = cls.engine_options()
+        async_options = {key: value for key, value in cls.engine_options().items() if key != 'poolclass'}
+        async_db.configure(cls.db_url, **async_options)
+        replica = cls.replica_config
+        replica_router.configure(flapp, replica['URLS'], strategy=replica['STRATEGY'], max_lag=replica['MAX_LAG'],
+                                 retry_after=replica['RETRY_AFTER'], health_interval=replica['HEALTH_INTERVAL'])
 
         flapp.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+        cls.configure_profiler()
+        sql_profiler.install(flapp)
+
+        sql_db.init_app(flapp)  # the engines are created by their first use
+        sql_db.before_engine(cls.before_engine)
+        Monitor.add_collector(cls.export_pool_metrics)
+
+    @classmethod
+    def configure_profiler(cls):
+        profile = cls.profile_config
+        sql_profiler.configure(enabled=profile['ENABLED'], slow_request_ms=profile['SLOW_REQUEST_MS'],
+                               n_plus_one=profile['N_PLUS_ONE'], debug_header=profile['DEBUG_HEADER'])
+
+    @classmethod
+    def reload_settings(cls):
+        """
+        after the yaml is hot reloaded: re-applies the settings that can change in a running worker, the SQL
+        profiling. the url, pool and replica settings are re-read but only take effect on a restart
+        """
+        cls.db_config()
+        cls.configure_profiler()
+
+    @classmethod
+    def warm_up(cls, flapp):
+        """
+        the startup work a LAZY startup leaves to the first request: creates the database if missing, configures
+        the mappers (so the models must be imported) and opens the PREWARM connections
+        """
+        startup = ob.get('startup') or StartupTimer()
+        cls.ensure_database()
+        startup.mark('database_check')
+        orm.configure_mappers()
+        startup.mark('mappers')
+        if cls.pool_config['PREWARM']:
+            with flapp.app_context():
+                prewarm(sql_db.engine, cls.pool_config['PREWARM'])
+            startup.mark('prewarm')
+
+    @classmethod
+    def dispose_engines(cls, flapp):
+        """
+        closes the pooled connections of every engine (the primary, the binds and the replicas) and gives each
+        a new, empty pool. the prefork server's master calls it before each fork, so a worker never inherits a
+        connection, whose socket it would share with the master and its siblings
+        """
+        with flapp.app_context():
+            for bind in [None] + list(flapp.config['SQLALCHEMY_BINDS']):
+                sql_db.get_engine(flapp, bind).dispose()
+
+    @classmethod
+    def after_fork(cls, flapp):
+        """in a new worker: opens its own PREWARM connections"""
+        if cls.pool_config['PREWARM']:
+            with flapp.app_context():
+                prewarm(sql_db.engine, cls.pool_config['PREWARM'])
+
+    @classmethod
+    def before_engine(cls, sa_url):
+        # a LAZY startup has not checked the database yet, the first engine does it before it connects
+        cls.ensure_database()
+
+    @classmethod
+    def ensure_database(cls):
+        """creates the database if it is missing; checked once per process, by warm_up or the first engine"""
+        if cls.database_checked:
+            return
+        if not database_exists(cls.db_url):  # database_exists disposes of its own engine
+            create_database(cls.db_url)
+        cls.database_checked = True
 
     @classmethod
     def db_config(cls):
         ydict = cls.config.yaml_config.path_get('Database-Connections/MySQL/APP')
 
-        cls.db_host = config.yaml_config.path_get(f'{cls.config_mode}/DB_HOST', ydict)
-        cls.db_user = config.yaml_config.path_get(f'{cls.config_mode}/DB_USER', ydict)
-        cls.db_pwd = config.yaml_config.path_get(f'{cls.config_mode}/DB_PASS', ydict)
-        cls.db_name = config.yaml_config.path_get(f'{cls.config_mode}/DB_NAME', ydict)
-        cls.db_url = f"mysql+pymysql://{cls.db_user}:{cls.db_pwd}@{cls.db_host}/{cls.db_name}"
+        # a full DB_URL (e.g. sqlite:///local.db as a local stand-in) replaces the MySQL host/user/pass/name
+        cls.db_url = cls.optional_section(f'{cls.config_mode}/DB_URL', ydict, None)
+        if not cls.db_url:
+            cls.db_host = cls.config.yaml_config.path_get(f'{cls.config_mode}/DB_HOST', ydict)
+            cls.db_user = cls.config.yaml_config.path_get(f'{cls.config_mode}/DB_USER', ydict)
+            cls.db_pwd = cls.config.yaml_config.path_get(f'{cls.config_mode}/DB_PASS', ydict)
+            cls.db_name = cls.config.yaml_config.path_get(f'{cls.config_mode}/DB_NAME', ydict)
+            cls.db_url = f"mysql+pymysql://{cls.db_user}:{cls.db_pwd}@{cls.db_host}/{cls.db_name}"
+
+        pool_ydict = cls.optional_section(f'{cls.config_mode}/POOL', ydict, {})
+        cls.pool_config = {key: pool_ydict.get(key, default) for key, default in cls.pool_defaults.items()}
+        replica_ydict = cls.optional_section(f'{cls.config_mode}/REPLICAS', ydict, {})
+        cls.replica_config = {key: replica_ydict.get(key, default) for key, default in cls.replica_defaults.items()}
+        profile_ydict = cls.optional_section(f'{cls.config_mode}/SQL_PROFILE', ydict, {})
+        cls.profile_config = {key: profile_ydict.get(key, default) for key, default in cls.profile_defaults.items()}
+
+    @classmethod
+    def optional_section(cls, ypath, ydict, default):
+        try:
+            return cls.config.yaml_config.path_get(ypath, ydict)
+        except YAMLError:
+            return default
+
+    @classmethod
+    def engine_options(cls):
+        pool = cls.pool_config
+        options = {'pool_pre_ping': pool['POOL_PRE_PING']}
+        if not cls.db_url.startswith('sqlite'):  # sqlite keeps its own single-file pooling
+            options.update({
+                'poolclass': MonitoredQueuePool,
+                'pool_size': pool['POOL_SIZE'],
+                'max_overflow': pool['MAX_OVERFLOW'],
+                'pool_timeout': pool['POOL_TIMEOUT'],
+                'pool_recycle': pool['POOL_RECYCLE'],
+            })
+        else:  # concurrent writers wait for sqlite's file lock like for a pool connection, not 5s
+            options['connect_args'] = {'timeout': pool['POOL_TIMEOUT']}
+        return options
+
+    @classmethod
+    def pool_metrics(cls):
+        """checked-out / overflow connections and checkout wait times of the app's engine pool"""
+        pool = sql_db.engine.pool
+        if isinstance(pool, MonitoredQueuePool):
+            return pool.metrics()
+        return {'status': pool.status()}
+
+    @classmethod
+    def export_pool_metrics(cls, pool=None):
+        """
+        sets the pool gauges from pool_metrics(); a Monitor collector, a no-op outside an app context and for
+        a pool that keeps no metrics (sqlite)
+        :param pool: default the app's engine pool
+        """
+        if pool is None:
+            if not has_app_context():
+                return
+            pool = sql_db.engine.pool
+        if not isinstance(pool, MonitoredQueuePool):
+            return
+        metrics = pool.metrics()
+        for state in ('size', 'checked_in', 'checked_out', 'overflow'):
+            cls.pool_connections.set(metrics[state], (state,))
+        cls.pool_checkouts.set(metrics['checkouts'])
+        cls.pool_timeouts.set(metrics['timeouts'])
+        cls.pool_wait.set(metrics['wait_total_ms'] / 1000)
@@ -1,12 +1,39 @@
 '''this base model can be inhertied in all other models
 simply the field names for other tables which would be common can be written here as a base'''
 
+from itertools import islice
+
+from sqlalchemy import delete, event, insert, inspect, select, tuple_, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.ext import declarative as decl
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.evaluator import EvaluatorCompiler, UnevaluatableError
+from sqlalchemy.orm.util import identity_key
 # from sqla_stack.fl_sqla import sql_db
 from sqla_stack.fl_sqla import sql_db
+from sqla_stack.async_db import async_db
+from sqla_stack.replicas import replica_router
+from sqla_stack.unit_of_work import UnitOfWork
+from app.models.serializer import ModelSerializer
+from app.models.statement_cache import StatementCache
+from library.cache_helper import CacheBackend, MemoryCache
 Base = decl.declarative_base()
 
 
+def index_name(table, columns):
+    return F'ix_{table}_{"_".join(columns)}'
+
+
+def chunks(iterable, size):
+    '''yields lists of at most size items from iterable, without materializing it'''
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
 class BaseModel(Base):
     __abstract__ = True
 
@@ -14,6 +41,12 @@ class BaseModel(Base):
     def __tablename__(cls):
         return cls.__name__
 
+    __indexes__ = ()  # column name tuples, one (composite) index each, e.g. (('name_2', 'age_2'), ('user_key',))
+
+    @decl.declared_attr
+    def __table_args__(cls):
+        return tuple(sql_db.Index(index_name(cls.__tablename__, columns), *columns) for columns in cls.__indexes__)
+
     pid = sql_db.Column(sql_db.Integer(), primary_key=True, unique=True, autoincrement=True, nullable=False)
     created_on = sql_db.Column(sql_db.DateTime, nullable=False, server_default=sql_db.func.now())
     updated_on = sql_db.Column(sql_db.DateTime, nullable=False, server_default=sql_db.func.now(),
@@ -22,29 +55,253 @@ class BaseModel(Base):
     '''here all the commonly used crud functions are written . jutscall the class and 
     the function to save, delete or update or quuery.'''
 
+    write_listeners = []  # callables(model class), called after every committed write, e.g. cache invalidation
+
+    @classmethod
+    def add_write_listener(cls, listener):
+        BaseModel.write_listeners.append(listener)
+
+    @classmethod
+    def notify_write(cls):
+        for listener in BaseModel.write_listeners:
+            listener(cls)
+
+    @classmethod
+    def commit_or_defer(cls, after_commit=None):
+        """
+        commits, then runs after_commit() and the write listeners. inside a UnitOfWork all of it waits for
+        the unit of work's single commit
+        """
+        uow = UnitOfWork.current()
+        if uow is not None:
+            uow.defer(cls, after_commit)
+            return
+        sql_db.session.commit()
+        if after_commit is not None:
+            after_commit()
+        cls.notify_write()
+
     def save(self):
         try:
+            replica_router.mark_write()
             sql_db.session.add(self)
-            sql_db.session.commit()
+            self.commit_or_defer(self.uncache)
             return self
         except Exception as e:
             sql_db.session.rollback()
             raise e
 
     def update(self, new_dict):
+        self.uncache()  # before the change too, in case it changes a cached key like xid
+        replica_router.mark_write()
         for k, v in new_dict.items():
             setattr(self, k, v)
-        sql_db.session.commit()
+        self.commit_or_defer(self.uncache)
 
     def delete_me(self):
         try:
+            self.uncache()
+            replica_router.mark_write()
             sql_db.session.delete(self)
-            sql_db.session.commit()
+            self.commit_or_defer()
             return True
         except Exception as e:
             sql_db.session.rollback()
             raise e
 
+    @classmethod
+    def update_where(cls, filters, values, chunk_size=None, all_rows=False):
+        """
+        UPDATE ... SET values WHERE filters, without loading the rows. the entities of the session that match
+        are updated too, the entity cache of the model is cleared and the write listeners are notified
+        :param filters: {column name: value} (a None value is IS NULL) and-ed together, or a list of criteria
+        e.g. [User_2.created_on < cutoff]
+        :param values: {column name: new value}
+        :param chunk_size: update at most chunk_size rows per statement and commit (by ascending pid), so a
+        very large update does not hold its locks for long. None for a single statement
+        :param all_rows: must be True to run without filters
+        :return: number of rows updated
+        """
+        return cls.write_where(update(cls).values(**values), filters, chunk_size, all_rows)
+
+    @classmethod
+    def delete_where(cls, filters, chunk_size=None, all_rows=False):
+        """
+        DELETE ... WHERE filters, without loading the rows, e.g. a retention purge. see update_where
+        :return: number of rows deleted
+        """
+        return cls.write_where(delete(cls), filters, chunk_size, all_rows)
+
+    @classmethod
+    def where_criteria(cls, filters):
+        if isinstance(filters, dict):
+            return [getattr(cls, key).is_(None) if value is None else getattr(cls, key) == value
+                    for key, value in filters.items()]
+        return list(filters)
+
+    @classmethod
+    def synchronize_strategy(cls, criteria):
+        """
+        'evaluate' applies the change to the matching entities already in the session without a SELECT, but
+        only works for criteria SQLAlchemy can evaluate in Python (comparisons, IN, and / or); the others,
+        e.g. LIKE or SQL functions, select the matching pids first with 'fetch'
+        """
+        if not criteria:
+            return 'evaluate'
+        try:
+            EvaluatorCompiler(cls).process(*criteria)
+        except UnevaluatableError:
+            return 'fetch'
+        return 'evaluate'
+
+    @classmethod
+    def write_where(cls, stmt, filters, chunk_size, all_rows):
+        criteria = cls.where_criteria(filters)
+        if not criteria and not all_rows:
+            raise ValueError(F'{cls.__name__}: no filters, pass all_rows=True to write every row')
+        replica_router.mark_write()
+        if chunk_size is None:
+            stmt = stmt.execution_options(synchronize_session=cls.synchronize_strategy(criteria))
+            try:
+                count = sql_db.session.execute(stmt.where(*criteria)).rowcount
+                cls.commit_or_defer(cls.clear_entity_cache)
+            except Exception as e:
+                sql_db.session.rollback()
+                raise e
+            return count
+
+        count = 0
+        last_pid = None
+        while True:
+            pid_stmt = select(cls.pid).where(*criteria).order_by(cls.pid).limit(chunk_size)
+            if last_pid is not None:
+                pid_stmt = pid_stmt.where(cls.pid > last_pid)
+            try:
+                pids = sql_db.session.execute(pid_stmt).scalars().all()
+                if not pids:
+                    return count
+                chunk_stmt = stmt.where(cls.pid.in_(pids)).execution_options(synchronize_session='evaluate')
+                count += sql_db.session.execute(chunk_stmt).rowcount
+                cls.commit_or_defer(cls.clear_entity_cache)
+            except Exception as e:
+                sql_db.session.rollback()
+                raise e
+            last_pid = pids[-1]
+
+    @classmethod
+    def bulk_save(cls, iterable, batch_size=1000, skip_keys=None):
+        """
+        inserts rows with multi-row Core INSERTs and commits once per batch, instead of once per row
+        :param iterable: dicts of {column name: value} or unsaved instances of this model
+        :param batch_size: number of rows per INSERT and commit
+        :param skip_keys: optional column names; rows whose values for these already exist are not inserted.
+        this is checked with one query per batch, not one per row
+        :return: {'inserted': n, 'skipped': n}
+        """
+        counts = {'inserted': 0, 'skipped': 0}
+        replica_router.mark_write()
+        for chunk in chunks(iterable, batch_size):
+            rows = [cls._row_dict(row) for row in chunk]
+            if skip_keys:
+                existing = cls._existing_keys(skip_keys, rows)
+                new_rows = [row for row in rows if tuple(row.get(key) for key in skip_keys) not in existing]
+                counts['skipped'] += len(rows) - len(new_rows)
+                rows = new_rows
+            try:
+                for key_rows in cls._group_by_keys(rows):
+                    sql_db.session.execute(insert(cls.__table__), key_rows)
+                cls.commit_or_defer()
+            except Exception as e:
+                sql_db.session.rollback()
+                raise e
+            counts['inserted'] += len(rows)
+        return counts
+
+    @classmethod
+    def bulk_upsert(cls, rows, conflict_keys, batch_size=1000):
+        """
+        inserts rows, or updates the existing row when conflict_keys match, with multi-row
+        INSERT ... ON DUPLICATE KEY UPDATE (MySQL) or INSERT ... ON CONFLICT DO UPDATE (SQLite).
+        one commit per batch. conflict_keys must be covered by a primary key or unique constraint
+        :param rows: dicts of {column name: value} or instances of this model
+        :param conflict_keys: column names that identify an existing row
+        :return: {'inserted': n, 'updated': n}
+        """
+        counts = {'inserted': 0, 'updated': 0}
+        replica_router.mark_write()
+        dialect = sql_db.session().get_bind(mapper=cls.__mapper__).dialect.name
+        for chunk in chunks(rows, batch_size):
+            chunk = [cls._row_dict(row) for row in chunk]
+            num_existing = len(cls._existing_keys(conflict_keys, chunk))
+            try:
+                for key_rows in cls._group_by_keys(chunk):
+                    stmt = cls._upsert_stmt(dialect, conflict_keys, key_rows[0].keys())
+                    sql_db.session.execute(stmt, key_rows)
+                cls.commit_or_defer(cls.clear_entity_cache)
+            except Exception as e:
+                sql_db.session.rollback()
+                raise e
+            counts['updated'] += num_existing
+            counts['inserted'] += len(chunk) - num_existing
+        return counts
+
+    @classmethod
+    def clear_entity_cache(cls):
+        cache = cls.entity_cache()
+        if cache is not None:
+            cache.clear(prefix=F'{cls.__tablename__}:')
+
+    @classmethod
+    def _upsert_stmt(cls, dialect, conflict_keys, row_keys):
+        table = cls.__table__
+        if dialect == 'mysql':
+            stmt = mysql.insert(table)
+            excluded = stmt.inserted
+        elif dialect == 'sqlite':
+            stmt = sqlite.insert(table)
+            excluded = stmt.excluded
+        else:
+            raise Exception(F'In sql_db Model, bulk_upsert - dialect {dialect} is not supported')
+
+        set_values = {key: excluded[key] for key in row_keys if key not in conflict_keys}
+        if 'updated_on' in table.columns and 'updated_on' not in set_values:
+            set_values['updated_on'] = sql_db.func.now()  # Core upserts skip the column's onupdate
+
+        if dialect == 'mysql':
+            return stmt.on_duplicate_key_update(set_values)
+        return stmt.on_conflict_do_update(index_elements=list(conflict_keys), set_=set_values)
+
+    @classmethod
+    def _existing_keys(cls, keys, rows):
+        # one query for the whole chunk: which of the rows' key values are already in the table
+        key_values = {tuple(row.get(key) for key in keys) for row in rows}
+        if not key_values:
+            return set()
+        columns = [getattr(cls, key) for key in keys]
+        if len(columns) == 1:
+            criteria = columns[0].in_([values[0] for values in key_values])
+        else:
+            criteria = tuple_(*columns).in_(list(key_values))
+        try:
+            return {tuple(row) for row in sql_db.session.execute(select(*columns).where(criteria))}
+        except Exception as e:
+            sql_db.session.rollback()
+            raise e
+
+    @classmethod
+    def _row_dict(cls, row):
+        if isinstance(row, BaseModel):
+            return {key: value for key, value in row.get_attrib_dict().items() if value is not None}
+        return dict(row)
+
+    @staticmethod
+    def _group_by_keys(rows):
+        # an executemany compiles its INSERT from the first row, so rows are sent grouped by their column set
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+        return groups.values()
+
     @classmethod
     def my_field_list(cls):
         return list(cls.__table__.columns)
@@ -61,29 +318,133 @@ class BaseModel(Base):
         return attribs
 
     def to_dict(self):
-        ent_dict = {
-            'ent_type': self.__class__.__name__,
-            'attributes': self.get_attrib_dict()
-        }
-        return ent_dict
+        return self.serializer().to_dict(self)
+
+    @classmethod
+    def to_dict_many(cls, entities, columnar=False):
+        """JSON-ready dicts (dates formatted) of a result list, or one columnar dict, see ModelSerializer"""
+        return cls.serializer().to_dict_many(entities, columnar=columnar)
+
+    @classmethod
+    def to_json_many(cls, entities, columnar=False) -> bytes:
+        return cls.serializer().to_json_many(entities, columnar=columnar)
+
+    @classmethod
+    def serializer(cls) -> ModelSerializer:
+        # compiled by the mapper_configured event below, or here if called before the mappers are configured
+        serializer = cls.__dict__.get('_serializer')
+        if serializer is None:
+            serializer = ModelSerializer(cls)
+            cls._serializer = serializer
+        return serializer
 
     @classmethod
     def by_pid(cls, pid, check_only=False):
-        entity = cls.by_prop_val('pid', pid, check_only=check_only)
+        entity = cls.by_cached_prop_val('pid', pid, check_only=check_only)
         return entity
 
+    @classmethod
+    def by_pids(cls, pids, chunk_size=500):
+        """
+        batched by_pid: the entities already in the session are not read again, the others are read with one
+        IN query per chunk_size pids, instead of one query per pid
+        :param pids: any iterable, duplicates and None are ignored
+        :return: {pid: entity}, pids that do not exist are left out
+        """
+        identity_map = sql_db.session().identity_map
+        found, missing = {}, []
+        for pid in dict.fromkeys(pids):
+            if pid is None or pid in found:
+                continue
+            entity = identity_map.get(identity_key(cls, pid))
+            if entity is not None:
+                found[pid] = entity
+            else:
+                missing.append(pid)
+
+        stmt, params = cls.statement_cache().get({}, kind='pids')
+        for chunk in chunks(missing, chunk_size):
+            try:
+                entities = cls.execute_read(stmt, {'pids': chunk}).scalars().all()
+            except Exception as e:
+                sql_db.session.rollback()
+                raise e
+            found.update((entity.pid, entity) for entity in entities)
+        return found
+
     @classmethod
     def by_xid(cls, pid, check_only=False):
-        entity = cls.by_prop_val('xid', pid, check_only=check_only)
+        entity = cls.by_cached_prop_val('xid', pid, check_only=check_only)
+        return entity
+
+    '''optional read-through entity cache for by_pid / by_xid. off unless enable_entity_cache() is called for
+    the model. the cache holds column values, not ORM instances, so a hit is merged into the current session
+    without a SELECT, unless the session already holds the entity. save, update and delete_me invalidate the entity; writes from other processes are
+    only bounded by the ttl. only rows read in a clean session are cached: one with pending or flushed changes,
+    or inside a UnitOfWork, may read values a rollback discards'''
+
+    @classmethod
+    def enable_entity_cache(cls, cache: CacheBackend = None) -> CacheBackend:
+        cls._entity_cache = cache or MemoryCache()
+        return cls._entity_cache
+
+    @classmethod
+    def disable_entity_cache(cls):
+        cls._entity_cache = None
+
+    @classmethod
+    def entity_cache(cls) -> CacheBackend:
+        return cls.__dict__.get('_entity_cache')
+
+    @classmethod
+    def entity_cache_key(cls, key, val):
+        return F'{cls.__tablename__}:{key}:{val}'
+
+    @classmethod
+    def by_cached_prop_val(cls, key, val, check_only=False):
+        cache = cls.entity_cache()
+        if cache is None:
+            return cls.by_prop_val(key, val, check_only=check_only)
+
+        cache_key = cls.entity_cache_key(key, val)
+        attribs = cache.get(cache_key)
+        if attribs is not None:
+            # an instance the session already has may carry changes newer than the cache, it wins
+            loaded = sql_db.session.identity_map.get(identity_key(cls, attribs['pid']))
+            if loaded is not None:
+                return loaded
+            entity = cls(**attribs)
+            make_transient_to_detached(entity)
+            return sql_db.session.merge(entity, load=False)
+
+        entity = cls.by_prop_val(key, val, check_only=check_only)
+        if entity is not None and not sql_db.session().has_writes() and UnitOfWork.current() is None:
+            cache.set(cache_key, {name: getattr(entity, name) for name in entity.get_attrib_names()})
         return entity
 
+    def uncache(self):
+        cache = self.entity_cache()
+        if cache is None:
+            return
+        # the identity survives a commit's expiry, so this never reloads the entity
+        identity = inspect(self).identity
+        keys = {'pid': identity[0] if identity else self.__dict__.get('pid'), 'xid': self.__dict__.get('xid')}
+        for key, val in keys.items():
+            if val is not None:
+                cache.delete(self.entity_cache_key(key, val))
+
     @classmethod
     def by_prop_val(cls, key, val, check_only=False):
         return cls.by_prop_values({key: val}, check_only=check_only)
 
     @classmethod
-    def by_prop_values(cls, key_val_dicts, check_only=False):
-        results = cls.run_query(key_val_dicts)
+    def by_prop_values(cls, key_val_dicts, check_only=False, unique=False):
+        """
+        fetches a single entity. only one row is read (two with unique=True, just enough to tell an
+        ambiguous lookup apart), no matter how many rows match
+        :param unique: raise if the lookup matches more than one entity, instead of returning the first
+        """
+        results = cls.run_query(key_val_dicts, limit=2 if unique else 1)
         num_results = None  # for PEP
         try:
             num_results = len(results)
@@ -99,23 +460,121 @@ class BaseModel(Base):
                     return None
                 else:
                     raise Exception(F'In sql_db Model, get_entity - query {qstr} returned NO {kind} entity')
-            else:  # got more than one
-                return results[0]
+            else:  # got more than one, only possible with unique
+                raise Exception(F'In sql_db Model, get_entity - query {qstr} returned more than one {kind} entity')
 
     @classmethod
-    def list_by_query(cls, key_val_dicts):
+    def exists(cls, key_val_dicts):
+        stmt, params = cls.statement_cache().get(key_val_dicts, kind='exists')
+        try:
+            return bool(cls.execute_read(stmt, params).scalar())
+        except Exception as e:
+            sql_db.session.rollback()
+            raise e
+
+    @classmethod
+    def count(cls, key_val_dicts=None):
+        stmt, params = cls.statement_cache().get(key_val_dicts or {}, kind='count')
+        try:
+            return cls.execute_read(stmt, params).scalar()
+        except Exception as e:
+            sql_db.session.rollback()
+            raise e
+
+    @classmethod
+    def list_by_query(cls, key_val_dicts, readonly=False, columns=None, eager=()):
         lbq_dict = {key: value for key, value in key_val_dicts.items() if key_val_dicts[key] is not None}
-        entities = cls.run_query(lbq_dict)
+        entities = cls.run_query(lbq_dict, readonly=readonly, columns=columns, eager=eager)
         return entities
 
     @classmethod
-    def run_query(cls, key_val_dicts):
-        query = sql_db.session.query(cls)
-        for key, value in key_val_dicts.items():
-            attrib = getattr(cls, key)
-            query = query.filter(attrib == value)
+    def page(cls, key_val_dicts=None, after=None, limit=50, order_by='pid', descending=False, eager=()):
+        """
+        keyset pagination: each page starts right after the last row of the previous one, instead of at an
+        OFFSET, so a deep page costs the same as the first one. filters with a None value are ignored
+        like in list_by_query
+        :param after: the position returned as next_after with the previous page. a pid when ordering by pid,
+        otherwise an (order_by value, pid) pair
+        :param limit: number of entities per page
+        :param order_by: a column name. rows are ordered by (order_by, pid) so the order is total; a nullable
+        column's NULLs come first (last when descending)
+        :param eager: relationships loaded with the page, see run_query
+        :return: (entities, next_after) - next_after is None on the last page
+        """
+        filters = {key: value for key, value in (key_val_dicts or {}).items() if value is not None}
+        has_after = after is not None
+        after_null = has_after and order_by != 'pid' and after[0] is None  # a NULL order_by value
+        # one extra row tells whether there is a next page
+        stmt, params = cls.statement_cache().get(
+            filters, limit=limit + 1, keyset=(order_by, descending, has_after, after_null), eager=eager)
+        if has_after:
+            if order_by == 'pid':
+                params['after_pid'] = after
+            elif after_null:
+                params['after_pid'] = after[1]
+            else:
+                params['after_key'], params['after_pid'] = after
         try:
-            entities = query.all()
+            entities = cls.execute_read(stmt, params).scalars().all()
+        except Exception as e:
+            sql_db.session.rollback()
+            raise e
+
+        if len(entities) <= limit:
+            return entities, None
+        entities = entities[:limit]
+        last = entities[-1]
+        next_after = last.pid if order_by == 'pid' else (getattr(last, order_by), last.pid)
+        return entities, next_after
+
+    @classmethod
+    def statement_cache(cls) -> StatementCache:
+        # one cache per model class, subclasses do not share their parent's statements
+        cache = cls.__dict__.get('_statement_cache')
+        if cache is None:
+            cache = StatementCache(cls)
+            cls._statement_cache = cache
+        return cache
+
+    @classmethod
+    def execute_read(cls, stmt, params=None, execution_options=None):
+        """
+        runs a read-only statement on a read replica when replicas are configured (see ReplicaRouter),
+        otherwise on the primary. A session with changes (pending or flushed) or inside a UnitOfWork reads
+        from the primary, which has them. A replica that fails is taken out of rotation and the read is
+        retried on the primary
+        """
+        execution_options = execution_options or {}
+        session = sql_db.session()
+        bind = None
+        if not session.has_writes() and UnitOfWork.current() is None:
+            bind = replica_router.read_bind()
+        if bind is not None:
+            try:
+                with session.no_autoflush:  # nothing to flush, checked above; never flushed to a replica
+                    return session.execute(stmt, params, execution_options=execution_options,
+                                           bind_arguments={'bind': bind})
+            except DBAPIError:
+                replica_router.mark_failed(bind)
+                if not session.has_writes():
+                    session.rollback()  # ends the failed read's transaction, there is nothing of the caller's in it
+        return session.execute(stmt, params, execution_options=execution_options)
+
+    @classmethod
+    def run_query(cls, key_val_dicts, limit=None, readonly=False, columns=None, eager=()):
+        """
+        :param readonly: return the rows straight from Core (tuple-like Row objects, by attribute or by index)
+        instead of session-tracked entities: no identity map, no instrumentation, a fraction of the memory.
+        For listings that are read and serialized, not changed
+        :param columns: the column names to select, implies readonly. all of them by default
+        :param eager: relationship names loaded with the entities, one IN query each, e.g. ('user',) for
+        User_2 rows whose user is read. The relationships are lazy otherwise, see table_models
+        """
+        if readonly or columns:
+            return cls.run_rows(key_val_dicts, limit=limit, columns=columns)
+        stmt, params = cls.statement_cache().get(key_val_dicts, limit=limit, eager=eager)
+        try:
+            entities = cls.execute_read(stmt, params).scalars().all()
 
             if entities is None:  # query always returns at least an empty list
                 raise Exception
@@ -125,10 +584,22 @@ class BaseModel(Base):
         return entities
 
     @classmethod
-    def run_query_all(cls):
-        query = sql_db.session.query(cls)
+    def run_rows(cls, key_val_dicts, limit=None, columns=None):
+        columns = columns or [column.name for column in cls.my_field_list()]
+        stmt, params = cls.statement_cache().get(key_val_dicts, limit=limit, columns=columns)
         try:
-            entities = query.all()
+            return cls.execute_read(stmt, params).all()
+        except Exception as e:
+            sql_db.session.rollback()
+            raise e
+
+    @classmethod
+    def run_query_all(cls, readonly=False, columns=None):
+        if readonly or columns:
+            return cls.run_rows({}, columns=columns)
+        stmt, params = cls.statement_cache().get({})
+        try:
+            entities = cls.execute_read(stmt, params).scalars().all()
 
             if entities is None:  # query always returns at least an empty list
                 # raise SAQueryError
@@ -137,3 +608,69 @@ class BaseModel(Base):
             sql_db.session.rollback()
             raise e
         return entities
+
+    '''async versions of the read helpers, for async def endpoints. each call runs in its own short AsyncSession
+    (see AsyncDB), so several of them can be awaited at once with asyncio.gather. the entities they return are
+    not in sql_db.session'''
+
+    @classmethod
+    async def run_query_async(cls, key_val_dicts, limit=None):
+        stmt, params = cls.statement_cache().get(key_val_dicts, limit=limit)
+        async with async_db.session() as session:
+            result = await session.execute(stmt, params)
+            return result.scalars().all()
+
+    @classmethod
+    async def by_prop_values_async(cls, key_val_dicts, check_only=False):
+        results = await cls.run_query_async(key_val_dicts, limit=1)
+        if results:
+            return results[0]
+        if check_only:
+            return None
+        raise Exception(F'In sql_db Model, get_entity - query {key_val_dicts} returned NO {cls.__tablename__} entity')
+
+    @classmethod
+    async def by_pid_async(cls, pid, check_only=False):
+        return await cls.by_prop_values_async({'pid': pid}, check_only=check_only)
+
+    @classmethod
+    async def exists_async(cls, key_val_dicts):
+        stmt, params = cls.statement_cache().get(key_val_dicts, kind='exists')
+        async with async_db.session() as session:
+            return bool((await session.execute(stmt, params)).scalar())
+
+    @classmethod
+    async def count_async(cls, key_val_dicts=None):
+        stmt, params = cls.statement_cache().get(key_val_dicts or {}, kind='count')
+        async with async_db.session() as session:
+            return (await session.execute(stmt, params)).scalar()
+
+    @classmethod
+    def iter_query(cls, key_val_dicts=None, chunk_size=1000):
+        """
+        generator version of run_query for large results: rows are streamed from a server-side cursor
+        chunk_size at a time, and each chunk is expunged from the session once it has been yielded, so memory
+        stays flat however many rows match. the yielded entities are detached afterwards, and the session
+        should not be committed while the iteration is running
+        :param dict key_val_dicts: the {column name: value} filters, and-ed together
+        :param chunk_size: rows fetched (and held) at a time
+        """
+        stmt, params = cls.statement_cache().get(key_val_dicts or {})
+        try:
+            result = cls.execute_read(stmt, params, execution_options={'yield_per': chunk_size})
+            for chunk in result.scalars().partitions(chunk_size):
+                yield from chunk
+                for entity in chunk:
+                    sql_db.session.expunge(entity)
+        except Exception as e:
+            sql_db.session.rollback()
+            raise e
+
+    @classmethod
+    def iter_all(cls, chunk_size=1000):
+        return cls.iter_query(chunk_size=chunk_size)
+
+
+@event.listens_for(BaseModel, 'mapper_configured', propagate=True)
+def compile_serializer(mapper, model):
+    model._serializer = ModelSerializer(model)
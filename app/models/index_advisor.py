@@ -0,0 +1,169 @@
+'''recommends indexes from the filter shapes the BaseModel query helpers actually run (counted by the
+StatementCache, merged over the workers through the Monitor's FileStore), checked with the database's EXPLAIN,
+and writes them, with the declared __indexes__ missing from the database, as a Flask-Migrate revision'''
+
+from alembic.autogenerate import render_python_code
+from alembic.operations import ops
+from alembic.script import ScriptDirectory
+from alembic.util import rev_id
+from flask import current_app
+from sqlalchemy import inspect
+
+from app.models.base import index_name
+from app.models.statement_cache import StatementCache
+from library.monitor.monitor import Monitor
+from sqla_stack.fl_sqla import sql_db
+
+
+class IndexAdvisor:
+    """
+    - observed_shapes() are the (table, filter keys, order column) combinations the queries used, the most
+    frequent first.
+    - An index covers a shape when its leading columns are the filter keys, in any order (they are all
+    equality filters), followed by the order column of a keyset page. The primary key covers any shape
+    filtering on pid.
+    - recommend() explains the top shapes and proposes an index for each one no index covers.
+    - write_revision() needs an app context and a migrations directory (python manage.py db init).
+    """
+
+    def __init__(self, models, top=10, min_count=1):
+        """
+        :param models: the model classes to advise on, e.g. models_by_name.values()
+        :param top: number of the most frequent shapes looked at
+        :param min_count: queries a shape needs before an index is proposed for it
+        """
+        self.models = {model.__tablename__: model for model in models}
+        self.top = top
+        self.min_count = min_count
+
+    def observed_shapes(self):
+        """[{'table', 'keys', 'order_by', 'count'}], the most frequent first"""
+        store = Monitor.get_store()
+        metric = store.collect(Monitor.registry).get(StatementCache.filter_shapes.name, {'values': {}})
+        shapes = []
+        for (table, keys, order_by), count in metric['values'].items():
+            if table in self.models:
+                shapes.append({'table': table, 'keys': tuple(keys.split(',')) if keys else (),
+                               'order_by': order_by, 'count': count})
+        return sorted(shapes, key=lambda shape: shape['count'], reverse=True)
+
+    def database_indexes(self, table):
+        """{index name: column names} of the table in the database, the primary key as 'PRIMARY'"""
+        inspector = inspect(sql_db.engine)
+        if not inspector.has_table(table):
+            return {}
+        indexes = {'PRIMARY': tuple(inspector.get_pk_constraint(table)['constrained_columns'])}
+        for index in inspector.get_indexes(table) + inspector.get_unique_constraints(table):
+            indexes[index['name']] = tuple(index['column_names'])
+        return indexes
+
+    @staticmethod
+    def declared_indexes(model):
+        return {index.name: tuple(column.name for column in index.columns) for index in model.__table__.indexes}
+
+    @staticmethod
+    def wanted_columns(keys, order_by):
+        columns = tuple(keys)
+        if order_by and order_by != 'pid' and order_by not in columns:
+            columns += (order_by,)
+        return columns
+
+    @classmethod
+    def covering_index(cls, indexes, keys, order_by):
+        """the name of the first index that covers the shape, None if none does"""
+        if 'pid' in keys:
+            return 'PRIMARY'
+        wanted = cls.wanted_columns(keys, order_by)
+        for name, columns in indexes.items():
+            leading = columns[:len(keys)]
+            if set(leading) == set(keys) and columns[len(keys):len(wanted)] == wanted[len(keys):]:
+                return name
+        return None
+
+    def explain(self, model, keys, order_by=''):
+        """
+        runs EXPLAIN QUERY PLAN (SQLite) or EXPLAIN (MySQL) on the statement of the shape
+        :return: {'plan': [the plan lines], 'full_scan': bool, 'filesort': bool}
+        """
+        shape = tuple((key, False) for key in keys)
+        stmt = model.statement_cache().build(shape, keyset=(order_by, False, False) if order_by else None)
+        engine = sql_db.engine
+        compiled = stmt.compile(dialect=engine.dialect)
+        params = compiled.construct_params({key: self.sample_value(model, key) for key in keys})
+        if compiled.positional:
+            params = tuple(params[name] for name in compiled.positiontup)
+
+        sqlite = engine.dialect.name == 'sqlite'
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(F'{"EXPLAIN QUERY PLAN" if sqlite else "EXPLAIN"} {compiled}',
+                                        params).mappings().all()
+        if sqlite:
+            plan = [row['detail'] for row in rows]
+            return {
+                'plan': plan,
+                'full_scan': any(line.startswith('SCAN') and 'INDEX' not in line for line in plan),
+                'filesort': any('TEMP B-TREE' in line for line in plan),
+            }
+        plan = [F"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row['Extra'] or ''}"
+                for row in rows]
+        return {
+            'plan': plan,
+            'full_scan': any(row['type'] == 'ALL' for row in rows),
+            'filesort': any('filesort' in (row['Extra'] or '') for row in rows),
+        }
+
+    @staticmethod
+    def sample_value(model, key):
+        # the plan of an equality filter does not depend on the value, only its type
+        try:
+            return model.__table__.columns[key].type.python_type()
+        except (NotImplementedError, TypeError):
+            return None
+
+    def recommend(self):
+        """
+        [{'table', 'keys', 'order_by', 'count', 'covered_by', 'explain', 'index'}] for the top shapes.
+        'index' is the proposed {'name', 'table', 'columns'}, None when an index covers the shape
+        """
+        recommendations = []
+        for shape in self.observed_shapes():
+            if len(recommendations) >= self.top or shape['count'] < self.min_count:
+                break
+            if not shape['keys'] and shape['order_by'] in ('', 'pid'):
+                continue  # a full listing, no index helps
+            model = self.models[shape['table']]
+            indexes = dict(self.database_indexes(shape['table']), **self.declared_indexes(model))
+            covered_by = self.covering_index(indexes, shape['keys'], shape['order_by'])
+            index = None
+            if covered_by is None:
+                columns = self.wanted_columns(shape['keys'], shape['order_by'])
+                index = {'name': index_name(shape['table'], columns), 'table': shape['table'], 'columns': columns}
+            recommendations.append(dict(shape, covered_by=covered_by, index=index,
+                                        explain=self.explain(model, shape['keys'], shape['order_by'])))
+        return recommendations
+
+    def missing_declared(self):
+        """[{'name', 'table', 'columns'}] declared in the models' __indexes__ but not in the database"""
+        missing = []
+        for table, model in self.models.items():
+            existing = self.database_indexes(table)
+            for name, columns in self.declared_indexes(model).items():
+                if name not in existing:
+                    missing.append({'name': name, 'table': table, 'columns': columns})
+        return missing
+
+    def write_revision(self, indexes, message='add indexes', directory=None):
+        """
+        writes a revision creating indexes (and dropping them on downgrade) into the Flask-Migrate migrations
+        :param indexes: [{'name', 'table', 'columns'}], e.g. the 'index' of the recommendations
+        :return: the path of the revision file
+        """
+        config = current_app.extensions['migrate'].migrate.get_config(directory)
+        upgrade_ops = ops.UpgradeOps(ops=[
+            ops.CreateIndexOp(index['name'], index['table'], list(index['columns'])) for index in indexes])
+        downgrade_ops = ops.DowngradeOps(ops=[
+            ops.DropIndexOp(index['name'], table_name=index['table']) for index in reversed(indexes)])
+        script = ScriptDirectory.from_config(config).generate_revision(
+            rev_id(), message, refresh=True, head='head', config=config,
+            upgrades=render_python_code(upgrade_ops), downgrades=render_python_code(downgrade_ops))
+        return script.path
@@ -0,0 +1,132 @@
+'''prepared select statements for the BaseModel query helpers. one statement is built per filter shape
+(the sorted filter keys) and reused for every call, only the bound values change'''
+
+from sqlalchemy import select, bindparam, func, and_, or_
+from sqlalchemy.orm import selectinload
+
+from library.monitor.monitor import Monitor
+
+
+class StatementCache:
+    # what the queries filter and order by, merged over the workers like the other metrics; read by the
+    # IndexAdvisor. the values are column names, so the number of label sets stays small
+    filter_shapes = Monitor.registry.counter(
+        'db_filter_shapes_total', 'Model queries by table, filter keys and keyset order column.',
+        ('table', 'keys', 'order_by'))
+
+    def __init__(self, model):
+        self.model = model
+        self._stmts = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def shape_of(key_val_dicts):
+        # a None value compiles to IS NULL, not to a bound "= :key", so it is part of the shape
+        return tuple(sorted((key, value is None) for key, value in key_val_dicts.items()))
+
+    def get(self, key_val_dicts, kind='entities', limit=None, keyset=None, columns=None, eager=()):
+        """
+        returns the prepared statement for the filter shape of key_val_dicts and the params to bind to it
+        :param dict key_val_dicts: the {column name: value} filters, and-ed together
+        :param kind: 'entities' selects the model, 'count' selects COUNT(*), 'exists' selects EXISTS(...) and
+        'pids' selects the model by a list of pids, bound to :pids
+        :param limit: optional LIMIT for an 'entities' statement
+        :param keyset: optional (order_by, descending, has_after[, after_null]) for an 'entities' statement, see
+        keyset_criteria()
+        :param columns: optional column names; an 'entities' statement then selects only these table columns,
+        as plain rows
+        :param eager: relationship names an 'entities' statement loads right after its rows, with one IN query
+        each (selectinload), for the callers that walk them
+        """
+        cache_key = (self.shape_of(key_val_dicts), kind, limit, keyset, tuple(columns) if columns else None,
+                     tuple(eager))
+        stmt = self._stmts.get(cache_key)
+        if stmt is None:
+            self.misses += 1
+            stmt = self.build(*cache_key)
+            self._stmts[cache_key] = stmt
+        else:
+            self.hits += 1
+
+        if kind != 'pids':
+            self.filter_shapes.inc((self.model.__tablename__, ','.join(key for key, _ in cache_key[0]),
+                                    keyset[0] if keyset else ''))
+        params = {key: value for key, value in key_val_dicts.items() if value is not None}
+        return stmt, params
+
+    def build(self, shape, kind='entities', limit=None, keyset=None, columns=None, eager=()):
+        criteria = []
+        for key, is_null in shape:
+            attrib = getattr(self.model, key)
+            criteria.append(attrib.is_(None) if is_null else attrib == bindparam(key))
+
+        if kind == 'count':
+            return select(func.count()).select_from(self.model).where(*criteria)
+        if kind == 'exists':
+            return select(select(self.model.pid).where(*criteria).exists())
+        if kind == 'pids':
+            return select(self.model).where(self.model.pid.in_(bindparam('pids', expanding=True)), *criteria)
+
+        stmt = select(*(self.table_columns(columns) if columns else [self.model])).where(*criteria)
+        if eager and not columns:
+            stmt = stmt.options(*(selectinload(getattr(self.model, name)) for name in eager))
+        if keyset is not None:
+            stmt = self.keyset_criteria(stmt, *keyset)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    def table_columns(self, names):
+        table_columns = self.model.__table__.columns
+        unknown = [name for name in names if name not in table_columns]
+        if unknown:
+            raise ValueError(F'{self.model.__name__} has no columns {unknown}')
+        return [table_columns[name] for name in names]
+
+    def keyset_criteria(self, stmt, order_by, descending, has_after, after_null=False):
+        """
+        orders by (order_by, pid), or just pid, and with has_after only selects rows past the
+        bound :after_key, :after_pid position. the comparison is spelled out with OR/AND rather than a row
+        value, so MySQL can use an index on the columns.
+        NULLs sort first ascending and last descending (MySQL and SQLite), and compare to nothing, so a
+        nullable order_by gets IS NULL branches; after_null is a position whose key is NULL, :after_key is
+        then not bound
+        """
+        pid = self.model.pid
+        column = getattr(self.model, order_by)
+        if descending:
+            order = [column.desc(), pid.desc()] if order_by != 'pid' else [pid.desc()]
+        else:
+            order = [column.asc(), pid.asc()] if order_by != 'pid' else [pid.asc()]
+
+        if has_after:
+            after_pid = bindparam('after_pid')
+            if order_by == 'pid':
+                stmt = stmt.where(pid < after_pid if descending else pid > after_pid)
+            else:
+                tie = pid < after_pid if descending else pid > after_pid
+                if after_null:  # the NULLs past the position, then (ascending) every non-NULL key
+                    past = and_(column.is_(None), tie)
+                    stmt = stmt.where(past if descending else or_(past, column.isnot(None)))
+                else:
+                    after_key = bindparam('after_key')
+                    past = column < after_key if descending else column > after_key
+                    criteria = [past, and_(column == after_key, tie)]
+                    if descending and column.nullable:
+                        criteria.append(column.is_(None))
+                    stmt = stmt.where(or_(*criteria))
+        return stmt.order_by(*order)
+
+    def clear(self):
+        self._stmts.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'model': self.model.__name__,
+            'shapes': len(self._stmts),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
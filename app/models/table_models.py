@@ -4,10 +4,25 @@
 from sqla_stack.fl_sqla import sql_db
 from app.models.base import BaseModel
 
+# how each relationship is loaded by default: 'select' (lazily, one query per entity on first access),
+# 'selectin' (one IN query per result list, right after it) or 'joined' (a LEFT OUTER JOIN in the same query).
+# lazily, so the queries that do not walk them (by_pid, page, the serializers) pay nothing; the ones that do
+# ask for them with run_query / list_by_query / page(eager=(...))
+relationship_loading = {
+    'User.users_2': 'select',
+    'User_2.user': 'select',
+}
+
 
 class User(BaseModel):
+    __indexes__ = (('name',),)  # by_name
+
     name = sql_db.Column(sql_db.String(80))
     age = sql_db.Column(sql_db.Integer())
+    # deleting a User keeps its User_2 rows and unlinks them (user_key set to NULL): the session does it for
+    # delete_me, the foreign key's ON DELETE SET NULL for delete_where
+    users_2 = sql_db.relationship('User_2', back_populates='user', lazy=relationship_loading['User.users_2'],
+                                  cascade='save-update, merge', passive_deletes=False)
     '''use the common query methods from base to query this table like query by name, filter
     by age'''
 
@@ -17,31 +32,35 @@ class User(BaseModel):
 
 
 class User_2(BaseModel):
+    __indexes__ = (
+        ('name_2', 'age_2'),  # by_name_and_age, chk_and_create
+        ('user_key',),  # by_user_key, the User.users_2 relationship
+    )
+
     name_2 = sql_db.Column(sql_db.String(80))
     age_2 = sql_db.Column(sql_db.Integer())
-    user_key = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('User.pid'))
+    user_key = sql_db.Column(sql_db.Integer, sql_db.ForeignKey('User.pid', ondelete='SET NULL'))
+    user = sql_db.relationship('User', back_populates='users_2', lazy=relationship_loading['User_2.user'])
 
     @classmethod
     def by_user_key(cls, user_key, check_only=True):
-        return cls.by_prop_val('name', user_key, check_only=check_only)
+        return cls.by_prop_val('user_key', user_key, check_only=check_only)
 
     '''a method to create sample values in db's table if needed to save as default values'''
 
     @classmethod
     def extract_sample_values_from_sample_data(cls):
         from app.models.sample_data import sample_datas
-        for data in sample_datas:
-            cls.chk_and_create(data)
+        return cls.bulk_save(sample_datas, skip_keys=('name_2', 'age_2'))
 
     @classmethod
     def chk_and_create(cls, data):
         name_2 = data.get('name_2')
         age_2 = data.get('age_2')
-        table_check = cls.by_name_and_age(name_2=name_2, age_2=age_2, check_only=True)
-        if table_check is None:
+        if not cls.exists({'name_2': name_2, 'age_2': age_2}):
             usr2 = User_2()
-            usr2.sf_name = data.get('name_2')
-            usr2.nxg_name = data.get('age_2')
+            usr2.name_2 = name_2
+            usr2.age_2 = age_2
             usr2.save()
 
     @classmethod
@@ -50,3 +69,7 @@ class User_2(BaseModel):
         return cls.by_prop_values(key_val_dicts, check_only=check_only)
 
     ''' get the data from sample data, checking if it previously exists, then save them'''
+
+
+# the models by their public name, for the generic export / import endpoints and commands
+models_by_name = {'user': User, 'user_2': User_2}
@@ -0,0 +1,190 @@
+'''bulk import of CSV / NDJSON files into a model. records are parsed and coerced to the column types in a
+process pool, and written with the model's chunked multi-row bulk_save'''
+
+import csv
+import datetime as dt
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import dateutil.parser as dtp
+from sqlalchemy import types as sql_types
+
+from app.models.base import chunks
+
+
+class ImportFileError(RuntimeError):
+    pass
+
+
+def column_schema(model):
+    """
+    a picklable description of the model's columns (from my_field_list) for the pool workers:
+    [(name, type tag, max length, required)]. pid and columns with a default are never required
+    """
+    schema = []
+    for column in model.my_field_list():
+        col_type = column.type
+        if isinstance(col_type, sql_types.Boolean):
+            tag = 'bool'
+        elif isinstance(col_type, sql_types.Integer):
+            tag = 'int'
+        elif isinstance(col_type, (sql_types.Float, sql_types.Numeric)):
+            tag = 'float'
+        elif isinstance(col_type, sql_types.DateTime):
+            tag = 'datetime'
+        elif isinstance(col_type, sql_types.Date):
+            tag = 'date'
+        else:
+            tag = 'str'
+        has_default = column.primary_key or column.default is not None or column.server_default is not None
+        required = not column.nullable and not has_default
+        schema.append((column.name, tag, getattr(col_type, 'length', None), required))
+    return schema
+
+
+def coerce_value(tag, value):
+    if tag == 'int':
+        return int(value)
+    if tag == 'float':
+        return float(value)
+    if tag == 'bool':
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ('true', '1', 'yes')
+    if tag == 'datetime':
+        return value if isinstance(value, dt.datetime) else dtp.parse(value)
+    if tag == 'date':
+        return value if isinstance(value, dt.date) else dtp.parse(value).date()
+    return str(value)
+
+
+def validate_chunk(schema, records):
+    """
+    runs in the pool workers
+    :param schema: see column_schema()
+    :param records: [(line number, raw dict or an unparsable raw line)]
+    :return: (valid rows, [(line number, error, raw record)])
+    """
+    columns = {name: (tag, length, required) for name, tag, length, required in schema}
+    valid, rejected = [], []
+    for line_no, raw in records:
+        try:
+            if isinstance(raw, str):
+                raw = json.loads(raw)
+            if not isinstance(raw, dict):
+                raise ValueError('record is not an object')
+            if None in raw:  # csv.DictReader puts the fields past the header under None
+                raise ValueError(F'{len(raw[None])} more fields than the header')
+            unknown = set(raw) - set(columns)
+            if unknown:
+                raise ValueError(F'unknown columns {sorted(unknown)}')
+
+            row = {}
+            for name, (tag, length, required) in columns.items():
+                value = raw.get(name)
+                if value is None or value == '':  # csv has no null
+                    if required:
+                        raise ValueError(F'{name} is required')
+                    continue
+                try:
+                    value = coerce_value(tag, value)
+                except (TypeError, ValueError, OverflowError):
+                    raise ValueError(F'{name}: can not convert {value!r} to {tag}')
+                if length and tag == 'str' and len(value) > length:
+                    raise ValueError(F'{name}: longer than {length}')
+                row[name] = value
+            valid.append(row)
+        except ValueError as e:
+            rejected.append((line_no, str(e), raw))
+    return valid, rejected
+
+
+def read_records(file_obj, fmt):
+    """yields (line number, record) - csv dicts, or the raw ndjson lines (decoded by the workers)"""
+    if fmt == 'csv':
+        reader = csv.DictReader(file_obj)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'ndjson':
+        for line_no, line in enumerate(file_obj, start=1):
+            line = line.strip()
+            if line:
+                yield line_no, line
+    else:
+        raise ImportFileError(F'Unknown import format: {fmt}. Expected csv or ndjson')
+
+
+def format_of(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'csv' if str(path).lower().endswith('.csv') else 'ndjson'
+
+
+class ModelImporter:
+    """
+    - import_file() / import_stream() load records into a BaseModel.
+    - Parsing and type coercion run in a process pool of `workers` processes (0 runs them in this process).
+    At most 2 chunks per worker are in flight, so memory does not grow with the file.
+    - Valid rows are written with model.bulk_save, one multi-row INSERT and commit per batch.
+    - Rejected records are counted, the first max_reject_samples are kept in the report, and every one
+    of them is written to rejects_path as NDJSON if it is given.
+    """
+    max_reject_samples = 100
+
+    def __init__(self, model, batch_size=5000, workers=None, rejects_path=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.workers = os.cpu_count() if workers is None else workers
+        self.rejects_path = rejects_path
+        self.schema = column_schema(model)
+
+    def import_file(self, path, fmt=None):
+        with open(path, newline='') as file_obj:
+            return self.import_stream(file_obj, format_of(path, fmt))
+
+    def import_stream(self, file_obj, fmt):
+        report = {'model': self.model.__name__, 'rows': 0, 'inserted': 0, 'rejected': 0, 'reject_samples': []}
+        rejects_file = open(self.rejects_path, 'w') if self.rejects_path else None
+        started = time.perf_counter()
+        try:
+            for valid, rejected in self.validated_chunks(read_records(file_obj, fmt)):
+                report['rows'] += len(valid) + len(rejected)
+                if valid:
+                    report['inserted'] += self.model.bulk_save(valid, batch_size=self.batch_size)['inserted']
+                self.record_rejects(report, rejected, rejects_file)
+        finally:
+            if rejects_file:
+                rejects_file.close()
+
+        seconds = time.perf_counter() - started
+        report['seconds'] = round(seconds, 3)
+        report['rows_per_sec'] = round(report['rows'] / seconds, 1) if seconds else None
+        return report
+
+    def validated_chunks(self, records):
+        record_chunks = chunks(records, self.batch_size)
+        if not self.workers:
+            for record_chunk in record_chunks:
+                yield validate_chunk(self.schema, record_chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = deque()
+            for record_chunk in record_chunks:
+                in_flight.append(executor.submit(validate_chunk, self.schema, record_chunk))
+                if len(in_flight) >= 2 * self.workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    def record_rejects(self, report, rejected, rejects_file):
+        report['rejected'] += len(rejected)
+        for line_no, error, raw in rejected:
+            reject = {'line': line_no, 'error': error, 'record': raw}
+            if len(report['reject_samples']) < self.max_reject_samples:
+                report['reject_samples'].append(reject)
+            if rejects_file:
+                rejects_file.write(json.dumps(reject, default=str) + '\n')
@@ -0,0 +1,70 @@
+'''the benchmark cases: the BaseModel hot paths and the HTTP endpoints. a case is a function of
+(runner, op number), registered by name with the bench_case decorator'''
+
+from app.api.api import api_endpoint
+from app.models.table_models import User, User_2
+from flask_svc import app as flapp
+
+
+class BenchCase:
+
+    def __init__(self, name, func, ops_scale=1.0):
+        """:param ops_scale: fraction of the runner's ops this case runs, for the expensive ones"""
+        self.name = name
+        self.func = func
+        self.ops_scale = ops_scale
+
+
+cases = {}
+
+
+def bench_case(name, ops_scale=1.0):
+    def decorator(func):
+        cases[name] = BenchCase(name, func, ops_scale)
+        return func
+    return decorator
+
+
+@bench_case('save')
+def save(runner, num):
+    User(name=F'{runner.name_prefix}saved_{num}', age=num % 90).save()
+
+
+@bench_case('by_pid')
+def by_pid(runner, num):
+    User.by_pid(runner.user_pids[num % len(runner.user_pids)])
+
+
+@bench_case('by_name_and_age')
+def by_name_and_age(runner, num):
+    name_2, age_2 = runner.user_2_keys[num % len(runner.user_2_keys)]
+    User_2.by_name_and_age(name_2, age_2)
+
+
+@bench_case('list_by_query')
+def list_by_query(runner, num):
+    User.list_by_query({'age': num % 90})
+
+
+@bench_case('run_query_all', ops_scale=0.05)
+def run_query_all(runner, num):
+    User.run_query_all()
+
+
+@bench_case('to_dict')
+def to_dict(runner, num):
+    runner.sample_users[num % len(runner.sample_users)].to_dict()
+
+
+@bench_case('http_users')
+def http_users(runner, num):
+    """GET /users, with the response cache off unless the runner's response_cache is set"""
+    response = api_endpoint.test_endpoint('users', flapp, auth_token=api_endpoint.valid_auth_token,
+                                          limit=10 + num % 40)
+    assert response.status_code == 200, response.data
+
+
+@bench_case('http_counts')
+def http_counts(runner, num):
+    response = api_endpoint.test_endpoint('counts', flapp, auth_token=api_endpoint.valid_auth_token)
+    assert response.status_code == 200, response.data
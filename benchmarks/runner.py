@@ -0,0 +1,174 @@
+'''runs the benchmark cases against the real app and its configured database (point APP_YAML_CONFIG at a yaml
+with a local SQLite or MySQL stand-in DB_URL), and compares the results with a stored baseline'''
+
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import delete
+
+from app.api.api import api_endpoint
+from app.models.base import Base
+from app.models.table_models import User, User_2
+from sqla_stack.fl_sqla import sql_db
+
+
+def percentile(sorted_values, pct):
+    """nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def peak_rss_mb():
+    """the peak resident set size of this process so far, in MB (ru_maxrss is KB on linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class BenchRunner:
+    """
+    - seed() creates the tables if needed and inserts `rows` User and User_2 rows named bench_<n>.
+    - run() runs each case `ops` times (times its ops_scale) from `concurrency` threads, each thread in its own
+    app context. Like a request, every op ends with sql_db.session.remove(), outside the timed part.
+    - cleanup() deletes the seeded and saved bench_ rows.
+    - Both write to the database, so they refuse to run unless its name contains 'bench'.
+    - The endpoints' response cache is off while the cases run, unless response_cache is set; the hits and
+    misses of each case are reported either way.
+    """
+    name_prefix = 'bench_'
+    database_marker = 'bench'
+
+    def __init__(self, flapp, rows=1000, ops=1000, concurrency=4, warmup=20, response_cache=False):
+        self.flapp = flapp
+        self.response_cache = response_cache
+        self.rows = rows
+        self.ops = ops
+        self.concurrency = concurrency
+        self.warmup = warmup
+        self.user_pids = []
+        self.user_2_keys = []  # (name_2, age_2)
+        self.sample_users = []  # loaded, detached User entities
+        self._local = threading.local()
+
+    def check_database(self):
+        database = os.path.basename(sql_db.engine.url.database or '')
+        if self.database_marker not in database.lower():
+            raise RuntimeError(F'Refusing to benchmark the {database!r} database, the bench seeds and deletes rows '
+                               F'in it. Point APP_YAML_CONFIG at a database whose name contains '
+                               F'{self.database_marker!r}')
+
+    def seed(self):
+        with self.flapp.app_context():
+            self.check_database()
+            Base.metadata.create_all(sql_db.engine)
+            self.cleanup()
+            User.bulk_save({'name': F'{self.name_prefix}{num}', 'age': num % 90} for num in range(self.rows))
+            User_2.bulk_save({'name_2': F'{self.name_prefix}{num}', 'age_2': num % 90} for num in range(self.rows))
+            self.sample_users = [user for user in User.run_query_all() if user.name.startswith(self.name_prefix)]
+            self.user_pids = [user.pid for user in self.sample_users]
+            self.user_2_keys = [(F'{self.name_prefix}{num}', num % 90) for num in range(self.rows)]
+            sql_db.session.remove()
+
+    def cleanup(self):
+        with self.flapp.app_context():
+            self.check_database()
+            for model, column in ((User_2, User_2.name_2), (User, User.name)):
+                # autoescape: the _ of the prefix is not a LIKE wildcard
+                sql_db.session.execute(
+                    delete(model.__table__).where(column.startswith(self.name_prefix, autoescape=True)))
+            sql_db.session.commit()
+            sql_db.session.remove()
+
+    def run(self, cases, names=None):
+        """
+        :param cases: {name: BenchCase}
+        :param names: the case names to run, all by default
+        :return: the report, see as_report()
+        """
+        results = {}
+        for name, case in cases.items():
+            if names and name not in names:
+                continue
+            results[name] = self.run_case(case)
+        return self.as_report(results)
+
+    def enter_app_context(self):
+        if getattr(self._local, 'app_context', None) is None:
+            self._local.app_context = self.flapp.app_context()
+            self._local.app_context.push()
+
+    def timed_op(self, case, num):
+        self.enter_app_context()
+        started = time.perf_counter()
+        case.func(self, num)
+        elapsed = time.perf_counter() - started
+        sql_db.session.remove()
+        return elapsed
+
+    def run_case(self, case):
+        ops = max(int(self.ops * case.ops_scale), 1)
+        cache_stats = api_endpoint.response_cache.stats
+        api_endpoint.cache_enabled = self.response_cache
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(lambda num: self.timed_op(case, num), range(self.warmup)))
+                hits, misses = cache_stats.hits, cache_stats.misses
+                started = time.perf_counter()
+                latencies = sorted(executor.map(lambda num: self.timed_op(case, num), range(ops)))
+                wall = time.perf_counter() - started
+                hits, misses = cache_stats.hits - hits, cache_stats.misses - misses
+        finally:
+            api_endpoint.cache_enabled = True
+
+        return {
+            'ops': ops,
+            'ops_per_sec': round(ops / wall, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'response_cache_hits': hits,
+            'response_cache_misses': misses,
+        }
+
+    def as_report(self, results):
+        return {
+            'settings': {'rows': self.rows, 'ops': self.ops, 'concurrency': self.concurrency,
+                         'db': sql_db.engine.dialect.name if self.flapp else None},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+            'cases': results,
+        }
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    :param tolerance: fraction a case may be slower than the baseline: lower ops_per_sec or higher p95_ms
+    :return: [regression description], empty when no case regressed
+    """
+    regressions = []
+    for name, result in report['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        if base is None:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(F"{name}: ops_per_sec {result['ops_per_sec']} < baseline {base['ops_per_sec']}")
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(F"{name}: p95_ms {result['p95_ms']} > baseline {base['p95_ms']}")
+    return regressions
+
+
+def save_report(report, path):
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def load_report(path):
+    with open(path) as report_file:
+        return json.load(report_file)
@@ -2,6 +2,7 @@
 
 import root_settings as rt
 from library.config_helper import ConfigHelper, CfgSrc, YAMLHelper
+from library.object_broker import ob
 
 
 class Config(ConfigHelper):
@@ -31,10 +32,44 @@ class Config(ConfigHelper):
         else:
             self.set_config_mode(config_mode)
 
+        # LAZY skips the startup DB checks / connections, EAGER pays them before the first request
+        self.STARTUP = self.get_config_attrib(
+            attrib_name='APP_STARTUP',
+            option_val=self.get_config_attrib('AppConfig/Startup', option_val='LAZY'), source=CfgSrc.ENV)
+        assert self.STARTUP in ('LAZY', 'EAGER'), F'Startup should be LAZY or EAGER, not {self.STARTUP}'
+
     @classmethod
     def initialize(cls, flapp, config=None):            #initializing the database
 
         from app.models import DataBaseConfig
         DataBaseConfig.initialize(flapp, config)
 
+        from library.monitor.monitor import Monitor     # the metrics store shared by the workers
+        monitoring = config.yaml_config.ydict.get('Monitoring') or {}
+        Monitor.configure(monitoring.get('METRICS_DIR'), monitoring.get('FLUSH_INTERVAL') or 1.0)
+
+        # hot reload: a changed yaml is swapped in without a restart, the settings that can change are re-read
+        watch_interval = config.get_config_attrib('AppConfig/WatchInterval', option_val=-1)
+        if watch_interval > 0:
+            config.yaml_config.on_reload(lambda yaml_config: DataBaseConfig.reload_settings())
+            config.yaml_config.watch(watch_interval)
+
+    @classmethod
+    def warm_up(cls, flapp):            # the startup work a LAZY startup leaves to the first request
+        from app.models import DataBaseConfig
+        DataBaseConfig.warm_up(flapp)
+
+    @classmethod
+    def before_fork(cls, flapp):            # in the prefork server's master, before each worker is forked
+        from app.models import DataBaseConfig
+        DataBaseConfig.dispose_engines(flapp)
+
+    @classmethod
+    def after_fork(cls, flapp):             # in each new worker
+        from app.models import DataBaseConfig
+        DataBaseConfig.after_fork(flapp)
+
+
+ob.set_factory('config', Config)  # the .env and the yaml are read once per process, by the first ob.config
+
 
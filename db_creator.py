@@ -1,6 +1,7 @@
 import uuid
 import yaml
-from sqlalchemy import Table, create_engine, MetaData, orm, and_, Integer, Column, String, DateTime, ForeignKey, func
+from sqlalchemy import Table, create_engine, MetaData, orm, and_, Integer, Column, String, DateTime, ForeignKey, func, \
+    Index
 from pathlib import Path
 
 root_dir = Path(__file__).parent.parent
@@ -24,7 +25,8 @@ User = Table('User', metadata,
     Column('created_on', DateTime, default=func.now()),
     Column('updated_on', DateTime, onupdate=func.utc_timestamp()),
     Column('name', String(50)),
-    Column('age', Integer())
+    Column('age', Integer()),
+    Index('ix_User_name', 'name')
 )
 
 User_2 = Table('User_2', metadata,
@@ -33,8 +35,10 @@ User_2 = Table('User_2', metadata,
     Column('updated_on', DateTime, onupdate=func.utc_timestamp()),
     Column('name_2', String(50)),
     Column('age_2', Integer),
-    Column('user_key', Integer, ForeignKey("User.pid")),
-    Column('item_id', Integer)
+    Column('user_key', Integer, ForeignKey("User.pid", ondelete="SET NULL")),
+    Column('item_id', Integer),
+    Index('ix_User_2_name_2_age_2', 'name_2', 'age_2'),
+    Index('ix_User_2_user_key', 'user_key')
 )
 
 metadata.create_all(engine)
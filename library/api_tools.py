@@ -1,10 +1,27 @@
+import base64
+import csv
+import datetime as dt
+import hashlib
+import inspect
+import io
+import json
+import time
 import typing as typ
+from contextlib import nullcontext
 from functools import wraps
 
+import jsonschema
+from sqlalchemy import types as sql_types
 from werkzeug.exceptions import HTTPException
-from flask import request, Response, Blueprint, Flask, g as flask_g
+from flask import request, Response, Blueprint, Flask, g as flask_g, stream_with_context
 from flask.testing import FlaskClient
 
+from library.async_helper import run_coroutine
+from library.cache_helper import CacheBackend, MemoryCache, SQLiteCache
+from library.datetime_helper import DatetimeHelper
+from library.monitor.monitor import Monitor
+from sqla_stack.unit_of_work import UnitOfWork
+
 
 class HdrAuthTokenError(RuntimeError):
     def __init__(self, message, status_code):
@@ -13,6 +30,13 @@ class HdrAuthTokenError(RuntimeError):
         super().__init__(self.message)
 
 
+class APIValidationError(RuntimeError):
+    def __init__(self, message, status_code):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(self.message)
+
+
 class APIClass:
     """base class for all API classes"""
     endpoint: 'APIEndpoint' = None
@@ -24,48 +48,64 @@ class APIEndpoint:
     - The instance is initialized with the API blueprint, And, the authorization info
     - The rule() decorator is called for each API endpoint during module startup, IOW, BEFORE the endpoint is called.
     It sets up the endpoint.  See the rule() decorator, below.  Each endpoints "rules" are persisted in the
-    "rules_dict" - the key is the endpoint name.
+    "rules_dict" - the key is the endpoint name. The params and validators are compiled there, once, into
+    the "casts" and "schemas" used on every call.
     - The on_call() decorator is called whenever the endpoint is called.  It retrieves the "rules" for the endpoint
     and applies those rules, some before the endpoint is called, and some after it is called.  See on_call()
     """
 
-    def __init__(self, blueprint: Blueprint, valid_auth_token=None, header_key='Authorization'):
+    def __init__(self, blueprint: Blueprint, valid_auth_token=None, header_key='Authorization',
+                 response_cache: CacheBackend = None):
         """
         :param Blueprint blueprint: used in the rule decorator
         :param valid_auth_token: for simple UUID-type authorizations, It declares the expected, "valid" auth_token
         :param header_key: if the auth_token is being passed in the header, declares the expected header key
+        :param response_cache: where the responses of the endpoints declared with cache= are kept, see on_call()
         """
         self.blueprint = blueprint
         self.header_key = header_key
         self.valid_auth_token = valid_auth_token
         self.rules_dict: typ.Dict[str, dict] = {}
+        self.response_cache = response_cache or MemoryCache(max_size=1024, ttl=60)
+        self.cache_enabled = True  # False serves every call uncached, e.g. to benchmark the endpoints themselves
+
+    default_page_limit = 50
+    max_page_limit = 1000
+    export_content_types = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
 
-    def rule(self, routes, params: typ.List[str] = None, validators: typ.Dict[str, dict] = None, **options):
+    def rule(self, routes, params: typ.List[str] = None, validators: typ.Dict[str, dict] = None, cache=None,
+             **options):
         """
         rule decorator: this decorator runs when the module is being setup (before the endpoint is called).
-         - it declares any needed validators (see the validators param, below)
+         - it declares any needed validators (see the validators param, below), the JSON schemas and the params
+         casts are compiled here, once, not on every call
          - it calls the Blueprint's add_url_rule which eliminates the need for its route() decorator.
          - it remembers the Blueprint method; which is used in the test_endpoint(),
         :param routes: relative path from the Blueprint's url_prefix to the endpoint
         :param list params: describes expected, possible parameters
-        :param dict validators: defines validators for the endpoint's params, request data or response data
+        :param dict validators: defines validators for the endpoint's params, request data or response data:
+        JSON schemas under the keys 'args' (the cast query args, as an object), 'request' (the JSON body)
+        and/or 'response' (the JSON the endpoint returns)
+        :param cache: caches the endpoint's GET responses, see on_call()
         :param options: standard Blueprint kwargs
         """
         def decorator(func):
             func_name = func.__name__
 
-            if params:
-                param_dict = {}
-                for param in params:
-                    if isinstance(param, dict):
-                        param_dict.update(param)
-                    else:
-                        param_dict[param] = None
+            param_dict = {}
+            for param in params or []:
+                if isinstance(param, dict):
+                    param_dict.update(param)
+                else:
+                    param_dict[param] = None
 
-                self.rules_dict[func_name] = {
-                    'methods': options.get('methods'),
-                    'params': param_dict,
-                    'validators': validators}
+            self.rules_dict[func_name] = {
+                'methods': options.get('methods') or ['GET'],
+                'params': param_dict,
+                'casts': self.compile_casts(param_dict),
+                'validators': validators,
+                'schemas': self.compile_validators(func_name, validators),
+                'cache': cache}
 
             endpoint = options.pop("endpoint", func_name)
             route_list = routes if isinstance(routes, list) else [routes]
@@ -74,42 +114,167 @@ class APIEndpoint:
             return func
         return decorator
 
-    def on_call(self):
+    def on_call(self, cache=None, columnar=False, unit_of_work=False, expire_on_commit=True):
         """
         on_call decorator: this decorator is called whenever the endpoint is called.  It executes decorator rules -
-        some before and some after the endpoint is called
+        some before and some after the endpoint is called.
+        The endpoint may be an "async def": its coroutine is run on the process' event loop (see async_helper),
+        so it can await several queries (the BaseModel *_async helpers) or downstream calls at once. It runs on
+        the loop's thread, so it gets its inputs from its arguments, not from flask's request.
+        :param cache: True, or a dict with any of: ttl (seconds), tags (e.g. the tables the endpoint reads, the
+        cached responses are dropped by invalidate_tag() when one is written) and per_token (cache per auth token).
+        Successful GET responses are then kept in response_cache, keyed by the endpoint name, its url variables
+        and its cast query args, and served with an ETag; a matching If-None-Match gets a 304.
+        It can also be declared with rule(cache=...)
+        :param columnar: a list of model entities returned by the endpoint is serialized in columnar mode
+        The endpoint may return a str/bytes body, a Response, a model entity or a list of them, or other JSON
+        data; entities are serialized by their model's compiled serializer (see BaseModel.serializer).
+        :param unit_of_work: the endpoint's model writes are committed once, when it returns, and rolled back
+        together if it raises or returns an error Response (see sqla_stack.unit_of_work)
+        :param expire_on_commit: False keeps the written entities loaded after that commit, so serializing them
+        does not reload them
+        Every call is recorded by the Monitor: its latency, status code and sizes, by endpoint name.
         """
         def endpoint_wrapper(decorated_func):
-            @wraps(decorated_func)
-            def func_wrapper(*args, **kwargs):
+            is_async = inspect.iscoroutinefunction(decorated_func)
+
+            def call_endpoint(*args, **kwargs):
+                scope = UnitOfWork(expire_on_commit=expire_on_commit) if unit_of_work else nullcontext()
+                with scope as uow:
+                    if is_async:
+                        response = run_coroutine(decorated_func(*args, **kwargs))
+                    else:
+                        response = decorated_func(*args, **kwargs)
+                    if uow is not None and isinstance(response, Response) and response.status_code >= 400:
+                        uow.discard()
+
+                if isinstance(response, Response):
+                    return response  # it's an error or other non-200 response
+                if not isinstance(response, (str, bytes)):
+                    try:
+                        response = self.serialize(response, columnar=columnar)
+                    except TypeError as e:  # what the endpoint returned, not the request, is wrong
+                        raise APIValidationError(F'Invalid response: {e}', 500)
+
+                self.validate_response(flask_g.my_func_name, response)
+
+                return Response(response, status=200, headers={'content-type': 'application/json'})
+
+            def handle_call(*args, **kwargs):
                 try:
 
                     func_name = decorated_func.__name__
                     flask_g.my_func_name = func_name
+                    # g outlives the request when an app context was already pushed, e.g. in the tests
+                    flask_g.cast_args = flask_g.validation_ms = None
                     self.validate_hdr_auth_token()  # security first...
-                    # request jdata validator
-                    # request param, arg validator
-
-                    response = decorated_func(*args, **kwargs)
-
-                    if isinstance(response, Response):
-                        return response  # it's an error or other non-200 response
+                    self.validate_request(func_name)
 
-                    # response jdata validator
-
-                    return Response(response, status=200, headers={'content-type': 'application/json'})
+                    cache_policy = self.cache_policy(func_name, cache)
+                    if cache_policy is not None and request.method == 'GET':
+                        response = self.cached_call(func_name, cache_policy, call_endpoint, *args, **kwargs)
+                    else:
+                        response = call_endpoint(*args, **kwargs)
+                    if flask_g.get('validation_ms') is not None:
+                        response.headers['X-Validation-Ms'] = F"{flask_g.validation_ms:.3f}"
+                    return response
                 except HTTPException as http_err:
                     return Response(
                         F'Exception in {decorated_func.__name__}. XCP: {str(http_err)}', status=http_err.code)
                 except HdrAuthTokenError as hdr_err:
                     return Response(
                         F'Exception in {decorated_func.__name__}. XCP: {str(hdr_err)}', status=401)
+                except APIValidationError as val_err:
+                    return Response(
+                        F'Exception in {decorated_func.__name__}. XCP: {str(val_err)}', status=val_err.status_code)
                 except Exception as e:
                     return Response(
                         F'Exception in {decorated_func.__name__}. XCP: {str(e)}', status=400)
+
+            @wraps(decorated_func)
+            def func_wrapper(*args, **kwargs):
+                func_name = decorated_func.__name__
+                started = Monitor.request_started(func_name)
+                response = None
+                try:
+                    response = handle_call(*args, **kwargs)
+                    return response
+                finally:
+                    status = response.status_code if response is not None else 500
+                    response_bytes = None if response is None or response.is_streamed else response.content_length
+                    Monitor.request_finished(func_name, request.method, status, started,
+                                             request.content_length, response_bytes)
             return func_wrapper
         return endpoint_wrapper
 
+    @staticmethod
+    def serialize(data, columnar=False) -> bytes:
+        """JSON bytes of a model entity (anything with a serializer()), a list of entities, or other JSON data"""
+        serializer = getattr(data, 'serializer', None)
+        if serializer is not None:
+            return serializer().to_json(data)
+        if isinstance(data, (list, tuple)) and data:
+            serializer = getattr(data[0], 'serializer', None)
+            if serializer is not None and all(type(item) is type(data[0]) for item in data):
+                return serializer().to_json_many(data, columnar=columnar)
+        return json.dumps(data, separators=(',', ':'), default=APIEndpoint.json_default).encode()
+
+    @staticmethod
+    def json_default(value):
+        serializer = getattr(value, 'serializer', None)
+        if serializer is not None:  # an entity nested in other data, or in a list of mixed models
+            return {'ent_type': type(value).__name__, 'attributes': serializer().json_attributes(value)}
+        if hasattr(value, '_asdict'):  # a readonly row, see BaseModel.run_query
+            return value._asdict()
+        if isinstance(value, (dt.date, dt.time)):  # a datetime is a date
+            return DatetimeHelper.to_json(value)
+        raise TypeError(F'{type(value).__name__} is not JSON serializable')
+
+    def cache_policy(self, func_name, cache):
+        cache = cache if cache is not None else self.rules_dict.get(func_name, {}).get('cache')
+        if not cache or not self.cache_enabled:
+            return None
+        return {} if cache is True else cache
+
+    def response_cache_key(self, func_name, cache_policy, view_args):
+        args = self.cast_args(request.args) if func_name in self.rules_dict else request.args.to_dict()
+        key = F'{func_name}|{sorted(view_args.items())}|{sorted(args.items())}'
+        if cache_policy.get('per_token'):
+            token = request.headers.get(self.header_key) or ''
+            key = F'{key}|{hashlib.sha1(token.encode()).hexdigest()}'
+        return key
+
+    def cached_call(self, func_name, cache_policy, call_endpoint, *args, **kwargs):
+        cache_key = self.response_cache_key(func_name, cache_policy, kwargs)
+        cached = self.response_cache.get(cache_key)
+        if cached is None:
+            response = call_endpoint(*args, **kwargs)
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            cached = (body, response.headers.get('content-type'), hashlib.sha1(body).hexdigest())
+            self.response_cache.set(cache_key, cached, ttl=cache_policy.get('ttl'), tags=cache_policy.get('tags', ()))
+
+        body, content_type, etag = cached
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, status=200, headers={'content-type': content_type})
+        response.set_etag(etag)
+        return response
+
+    def invalidate_tag(self, tag):
+        self.response_cache.invalidate_tag(tag)
+
+    def share_response_cache(self, path):
+        """
+        replaces an in-process response cache with a SQLiteCache at path, of the same size and ttl, so the
+        invalidations of a write in one worker process reach the responses cached by the others
+        """
+        if isinstance(self.response_cache, MemoryCache):
+            self.response_cache = SQLiteCache(path, self.response_cache.max_size, self.response_cache.ttl)
+        return self.response_cache
+
     def get_params(self, *names):
         args = self.cast_args(request.args)
         targs = (args[name] if name in args else None for name in names)
@@ -125,24 +290,180 @@ class APIEndpoint:
         :return:
         """
         func_name = flask_g.my_func_name
-        # retrieve from the rules dict the functions parameter rules (if any)
-        if 'params' in self.rules_dict[func_name]:
-            param_defs = self.rules_dict[func_name].get('params')
-            # get the caller-supplied query params & values
-            cargs = dict(req_args.copy())  # copy as dict because args are immutable
-            for k, v in cargs.items():
-                # if there is a rule, and the rule defines an expected type
-                if param_defs.get(k) and v:
-                    # cast the query value to the rule's type
-                    # python bool() function casting always return True for non empty string.
-                    # https://stackoverflow.com/questions/21732123/convert-true-false-value-read-from-file-to-boolean?lq=1
-                    if param_defs[k] == bool:
-                        cargs[k] = v.lower() == 'true'
-                    else:
-                        cargs[k] = param_defs[k](v)
-            return cargs  # ones that had a matching rule now are of the expected type
-        else:  # No rules
+        if req_args is request.args and flask_g.get('cast_args') is not None:
+            return flask_g.cast_args  # already cast (and validated) by on_call for this request
+        # retrieve from the rules dict the functions compiled parameter casts (if any)
+        rules = self.rules_dict.get(func_name)
+        if rules is None:  # No rules
             return req_args
+        casts = rules['casts']
+        # get the caller-supplied query params & values
+        cargs = dict(req_args.copy())  # copy as dict because args are immutable
+        for k, v in cargs.items():
+            # if there is a rule, and the rule defines an expected type, cast the query value to the rule's type
+            cast = casts.get(k)
+            if cast and v:
+                cargs[k] = cast(v)
+        return cargs  # ones that had a matching rule now are of the expected type
+
+    @staticmethod
+    def compile_casts(param_dict):
+        """{param name: cast function} for the params that declare a type"""
+        casts = {}
+        for name, param_type in param_dict.items():
+            if param_type is None:
+                continue
+            if param_type == bool:
+                # python bool() function casting always return True for non empty string.
+                # https://stackoverflow.com/questions/21732123/convert-true-false-value-read-from-file-to-boolean?lq=1
+                casts[name] = lambda v: v.lower() == 'true'
+            else:
+                casts[name] = param_type
+        return casts
+
+    @staticmethod
+    def compile_validators(func_name, validators):
+        """checks each JSON schema once and builds its validator, {'args'|'request'|'response': validator}"""
+        schemas = {}
+        for target, schema in (validators or {}).items():
+            assert target in ('args', 'request', 'response'), \
+                F'{func_name}: unknown validator {target}, expected args, request or response'
+            validator_cls = jsonschema.validators.validator_for(schema)
+            validator_cls.check_schema(schema)
+            schemas[target] = validator_cls(schema)
+        return schemas
+
+    def validate_request(self, func_name):
+        """
+        casts the query args and validates them, and the JSON body, against the endpoint's compiled schemas.
+        The cast args are kept for cast_args() / get_params(), the time spent in flask_g.validation_ms
+        """
+        rules = self.rules_dict.get(func_name)
+        if not rules or not rules['schemas']:
+            return
+        started = time.perf_counter()
+        schemas = rules['schemas']
+        try:
+            flask_g.cast_args = self.cast_args(request.args)
+        except (TypeError, ValueError) as e:
+            raise APIValidationError(F'Invalid query args: {str(e)}', status_code=400)
+        self.validate(schemas.get('args'), flask_g.cast_args, 'query args', 400)
+        if 'request' in schemas:
+            self.validate(schemas['request'], request.get_json(silent=True), 'request body', 400)
+        flask_g.validation_ms = (time.perf_counter() - started) * 1000
+
+    def validate_response(self, func_name, response):
+        rules = self.rules_dict.get(func_name)
+        if not rules or 'response' not in rules['schemas']:
+            return
+        started = time.perf_counter()
+        data = json.loads(response) if isinstance(response, (str, bytes)) else response
+        self.validate(rules['schemas']['response'], data, 'response', 500)
+        flask_g.validation_ms = (flask_g.validation_ms or 0) + (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def validate(validator, instance, what, status_code):
+        if validator is None:
+            return
+        try:
+            validator.validate(instance)
+        except jsonschema.ValidationError as e:
+            path = '/'.join(str(item) for item in e.absolute_path)
+            raise APIValidationError(F'Invalid {what}{" at " + path if path else ""}: {e.message}', status_code)
+
+    def page_response(self, model, key_val_dicts=None, cursor=None, limit=None, order_by='pid', descending=False):
+        """
+        keyset-paginated listing of a BaseModel for list endpoints. The caller gets an opaque next_cursor
+        and passes it back as-is to get the next page; there is none on the last page.
+        :param model: the BaseModel class to list
+        :param key_val_dicts: filters, None values are ignored
+        :param cursor: the next_cursor of the previous page, None for the first page
+        :param limit: page size, capped at max_page_limit
+        :return: JSON {"items": [...], "next_cursor": str|null}
+        """
+        limit = min(limit or self.default_page_limit, self.max_page_limit)
+        after = self.decode_cursor(cursor, model, order_by, descending) if cursor else None
+        entities, next_after = model.page(
+            key_val_dicts, after=after, limit=limit, order_by=order_by, descending=descending)
+        body = {
+            'items': model.to_dict_many(entities),
+            'next_cursor': self.encode_cursor(order_by, descending, next_after) if next_after is not None else None
+        }
+        return json.dumps(body, default=DatetimeHelper.to_json)
+
+    def export_response(self, model, key_val_dicts=None, fmt='ndjson', chunk_size=1000):
+        """
+        streams every matching row of a BaseModel as NDJSON (one JSON object per line) or CSV (with a header
+        row), using chunked transfer. Rows are read lazily with model.iter_query, so memory stays flat and
+        the first bytes go out before the query is exhausted.
+        :param model: the BaseModel class to export
+        :param key_val_dicts: filters, None values are ignored
+        :param fmt: 'ndjson' or 'csv'
+        :param chunk_size: rows read from the db, and sent to the client, at a time
+        """
+        if fmt not in self.export_content_types:
+            raise ValueError(F'Unknown export format: {fmt}. Expected one of {list(self.export_content_types)}')
+        filters = {key: value for key, value in (key_val_dicts or {}).items() if value is not None}
+        serializer = model.serializer()
+        names = serializer.names
+
+        def rows():
+            for entity in model.iter_query(filters, chunk_size=chunk_size):
+                yield serializer.values(entity)
+
+        def ndjson_lines():
+            lines = []
+            for row in rows():
+                lines.append(json.dumps(dict(zip(names, row))))
+                if len(lines) == chunk_size:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+            if lines:
+                yield '\n'.join(lines) + '\n'
+
+        def csv_lines():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(names)
+            for num, row in enumerate(rows(), start=1):
+                writer.writerow(row)
+                if num % chunk_size == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        body = ndjson_lines() if fmt == 'ndjson' else csv_lines()
+        return Response(stream_with_context(body), status=200,
+                        headers={'content-type': self.export_content_types[fmt]})
+
+    @classmethod
+    def encode_cursor(cls, order_by, descending, after):
+        values = list(after) if isinstance(after, tuple) else [after]
+        values = [DatetimeHelper.to_json(value) if isinstance(value, (dt.date, dt.time)) else value
+                  for value in values]
+        raw = json.dumps([order_by, descending, values]).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    @classmethod
+    def decode_cursor(cls, cursor, model, order_by, descending):
+        """the inverse of encode_cursor. A cursor from a listing with a different order is rejected"""
+        try:
+            cur_order_by, cur_descending, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValueError(F'Invalid page cursor: {cursor}')
+        if cur_order_by != order_by or cur_descending != descending:
+            raise ValueError(F'Page cursor does not belong to a listing ordered by {order_by}')
+
+        if order_by == 'pid':
+            return values[0]
+        key, pid = values
+        column_type = getattr(model, order_by).type
+        if isinstance(column_type, sql_types.DateTime) and key is not None:
+            key = dt.datetime.fromisoformat(key)
+        elif isinstance(column_type, sql_types.Date) and key is not None:
+            key = dt.date.fromisoformat(key)
+        return key, pid
 
     def validate_hdr_auth_token(self):
         """
@@ -0,0 +1,80 @@
+import asyncio
+import atexit
+import os
+import threading
+
+
+class LoopThread:
+    """
+    - One asyncio event loop per process, run forever by a daemon thread, started on first use (and again in
+    a forked child: the thread does not survive the fork, the inherited loop is never reused).
+    - run() submits a coroutine from any thread and waits for its result, so every request thread shares the
+    one loop and whatever is bound to it, e.g. the async engine (see sqla_stack.async_db).
+    - The coroutines run on the loop's thread: the Flask request context is not bound there, contextvars are
+    (they are copied from the submitting thread). stop() awaits the on_shutdown() callbacks and closes the loop
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._shutdown_callbacks = []  # coroutine functions, awaited on the loop by stop()
+
+    def loop(self):
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    self._start()
+        return self._loop
+
+    def _start(self):
+        # the caller holds the lock
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(loop, started), name='async-loop', daemon=True)
+        self._thread.start()
+        started.wait()
+        self._loop = loop
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _run(loop, started):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(started.set)
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    def run(self, coro, timeout=None):
+        """runs coro on the process' loop, from sync code, and returns its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop()).result(timeout)
+
+    def on_shutdown(self, callback):
+        """:param callback: a coroutine function, e.g. AsyncDB.dispose"""
+        if callback not in self._shutdown_callbacks:
+            self._shutdown_callbacks.append(callback)
+
+    def stop(self, timeout=5.0):
+        loop, thread = self._loop, self._thread
+        if loop is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        for callback in self._shutdown_callbacks:
+            try:
+                asyncio.run_coroutine_threadsafe(callback(), loop).result(timeout)
+            except Exception:
+                pass  # shutting down anyway
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        self._loop = None
+
+
+loop_thread = LoopThread()
+atexit.register(loop_thread.stop)
+
+
+def run_coroutine(coro):
+    """runs coro to completion on the process' loop, from sync code, and returns its result"""
+    return loop_thread.run(coro)
@@ -0,0 +1,279 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class CacheStats:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hit_ratio, 4),
+        }
+
+
+class CacheBackend(ABC):
+    """
+    - A size-bounded LRU key/value cache where every entry expires after ttl seconds.
+    - get() returns None on a miss, so None itself can not be cached.
+    - An entry can carry tags; invalidate_tag() drops every entry with that tag.
+    - The concrete backends below decide where the entries live: MemoryCache in this process,
+    SQLiteCache in a file that all the workers on the host share (a local stand-in for memcached/redis)
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        """
+        :param max_size: number of entries kept, the least recently used entry is evicted beyond that
+        :param ttl: seconds an entry lives; None for no expiry
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None, tags=()):
+        """
+        :param ttl: seconds for this entry, instead of the cache's ttl
+        :param tags: names the entry can be invalidated by, e.g. the tables it was read from
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def invalidate_tag(self, tag):
+        pass
+
+    @abstractmethod
+    def clear(self, prefix=''):
+        """removes every entry whose key starts with prefix, or all of them"""
+
+    @abstractmethod
+    def size(self):
+        pass
+
+    def report(self):
+        report = self.stats.as_dict()
+        report.update({'size': self.size(), 'max_size': self.max_size, 'ttl': self.ttl})
+        return report
+
+
+class MemoryCache(CacheBackend):
+
+    def __init__(self, max_size=1024, ttl=60):
+        super().__init__(max_size, ttl)
+        self._entries = OrderedDict()  # key: (expires_at, value, tags), least recently used first
+        self._tags = {}  # tag: {keys}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            expires_at, value, tags = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires_at, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def _remove(self, key):
+        # the caller holds the lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self, prefix=''):
+        with self._lock:
+            if not prefix:
+                self._entries.clear()
+                self._tags.clear()
+                return
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._remove(key)
+
+    def size(self):
+        return len(self._entries)
+
+
+class SQLiteCache(CacheBackend):
+    """
+    shared by every process that opens the same file. values are pickled.
+    the stats are counted per process. the size is checked every check_every writes, so the cache can go up
+    to check_every entries past max_size before the least recently used ones are evicted.
+    a hit does not write: the use times are kept per thread and written in batches, with the next set() or
+    at most every touch_interval seconds, and an entry used within touch_interval is not touched again. the
+    LRU order is approximate to that, but the readers of the shared file do not queue for its write lock
+    """
+    touch_interval = 1.0
+
+    def __init__(self, path, max_size=1024, ttl=60):
+        super().__init__(max_size, ttl)
+        self.path = path
+        self.check_every = max(1, max_size // 10)
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._conn()
+        with self._transaction(conn):
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value BLOB, expires_at REAL, used_at REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_tags_key ON cache_tags (key)')
+
+    def _conn(self):
+        # sqlite3 connections can not cross threads, nor a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.touched = {}  # key: used_at, not written yet
+            self._local.touched_at = time.time()
+        return conn
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get(self, key):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute('SELECT value, expires_at, used_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < now):
+            self.stats.misses += 1
+            return None
+        if now - row[2] >= self.touch_interval:
+            self._local.touched[key] = now
+            if now - self._local.touched_at >= self.touch_interval:
+                with self._transaction(conn):
+                    self._write_touched(conn)
+        self.stats.hits += 1
+        return pickle.loads(row[0])
+
+    def _write_touched(self, conn):
+        # the caller holds a transaction
+        touched, self._local.touched = self._local.touched, {}
+        self._local.touched_at = time.time()
+        conn.executemany('UPDATE cache SET used_at = ? WHERE key = ?',
+                         [(used_at, key) for key, used_at in touched.items()])
+
+    def set(self, key, value, ttl=None, tags=()):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl is not None else None
+        conn = self._conn()
+        with self._transaction(conn):
+            self._write_touched(conn)
+            conn.execute('DELETE FROM cache_tags WHERE key = ?', (key,))  # the tags of the entry it replaces
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)',
+                (key, pickle.dumps(value), expires_at, now))
+            conn.executemany('INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)',
+                             [(tag, key) for tag in tags])
+        self._writes += 1
+        if self._writes >= self.check_every:
+            self._writes = 0
+            self.evict()
+
+    def evict(self):
+        """drops the least recently used entries past max_size"""
+        conn = self._conn()
+        with self._transaction(conn):
+            overflow = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_size
+            if overflow <= 0:
+                return
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS evicted (key TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM evicted')
+            conn.execute('INSERT INTO evicted SELECT key FROM cache ORDER BY used_at LIMIT ?', (overflow,))
+            conn.execute('DELETE FROM cache_tags WHERE key IN (SELECT key FROM evicted)')
+            conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM evicted)')
+        self.stats.evictions += overflow
+
+    def delete(self, key):
+        conn = self._conn()
+        with self._transaction(conn):
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            conn.execute('DELETE FROM cache_tags WHERE key = ?', (key,))
+
+    def invalidate_tag(self, tag):
+        conn = self._conn()
+        with self._transaction(conn):
+            conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache_tags WHERE tag = ?)', (tag,))
+            # with the other tags of those entries
+            conn.execute('DELETE FROM cache_tags WHERE key IN (SELECT key FROM cache_tags WHERE tag = ?)', (tag,))
+
+    def clear(self, prefix=''):
+        conn = self._conn()
+        with self._transaction(conn):
+            if not prefix:
+                conn.execute('DELETE FROM cache')
+                conn.execute('DELETE FROM cache_tags')
+                return
+            conn.execute('DELETE FROM cache WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+            conn.execute('DELETE FROM cache_tags WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+
+    def size(self):
+        return self._conn().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
@@ -1,10 +1,18 @@
+import hashlib
 import os
+import pickle
+import threading
 import dotenv
 import yaml
 from enum import Enum
 from flask import Flask
 from pathlib import Path
 
+try:
+    from yaml import CFullLoader as YAMLLoader  # libyaml, same tags as the FullLoader
+except ImportError:
+    from yaml import FullLoader as YAMLLoader
+
 
 class ConfigErr(RuntimeError):
     pass
@@ -19,26 +27,159 @@ class CfgSrc(Enum):
     YAML = 20
 
 
+class YAMLSnapshot:
+    """
+    one parse of the yaml file: the nested dict and a flat index of every path in it ('a/b/c': value),
+    so a path_get is one dict lookup instead of a walk. prefixes maps id() of each nested dict to its path,
+    for the lookups relative to a sub-dict (path_get's ydict)
+    """
+
+    def __init__(self, ydict, mtime=None, digest=None):
+        self.ydict = ydict
+        self.mtime = mtime
+        self.digest = digest
+        self.index = {}
+        self.prefixes = {id(ydict): ''}
+        self._add(ydict, '')
+
+    def _add(self, ydict, prefix):
+        for key, value in ydict.items():
+            path = F'{prefix}{key}'
+            self.index[path] = value
+            if isinstance(value, dict):
+                self.prefixes[id(value)] = F'{path}/'
+                self._add(value, F'{path}/')
+
+
 class YAMLHelper:
+    """
+    - The file is parsed with libyaml when it is installed, and the parse is cached on disk (in
+    YAML_CONFIG/__yamlcache__) keyed by the file's hash, so a worker that starts with an unchanged file
+    only unpickles it.
+    - watch() checks the file's mtime every interval seconds in a daemon thread and swaps in a new
+    snapshot when it changed. The swap is a single assignment: a lookup sees the old or the new file,
+    never a mix. Values copied at startup (e.g. the DB url) are not changed, on_reload() callbacks can
+    re-read the ones that may change.
+    """
+    cache_dir_name = '__yamlcache__'
 
     def __init__(self, yaml_file):
         self.yaml_file = yaml_file
-        self._ydict = None
+        self._snapshot: YAMLSnapshot = None
+        self._reload_callbacks = []
+        self._watch_interval = None
+        self._watcher = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def yaml_path(self):
+        # Get root dir path
+        root_dir = Path(__file__).parent.parent
+        return root_dir / 'YAML_CONFIG' / self.yaml_file
+
+    @property
+    def snapshot(self) -> YAMLSnapshot:
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self.load()
+        return self._snapshot
 
     @property
     def ydict(self):
+        return self.snapshot.ydict
+
+    def load(self):
+        path = self.yaml_path
+        mtime = os.stat(path).st_mtime_ns
+        # Read the yaml file
+        with open(path, 'rb') as file:
+            content = file.read()
+        digest = hashlib.sha1(content).hexdigest()
 
-        if self._ydict is None:
-            # Get root dir path
-            root_dir = Path(__file__).parent.parent
-            # Read the yaml file
-            with open(f"{root_dir}/YAML_CONFIG/{self.yaml_file}") as file:
-                self._ydict = yaml.load(file, Loader=yaml.FullLoader)
+        cache_path = path.parent / self.cache_dir_name / F'{path.name}.{digest}.pickle'
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                ydict = pickle.load(cache_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            ydict = yaml.load(content, Loader=YAMLLoader) or {}
+            self.write_cache(cache_path, ydict, stale_glob=F'{path.name}.*.pickle')
+        return YAMLSnapshot(ydict, mtime, digest)
 
-        return self._ydict
+    @classmethod
+    def write_cache(cls, cache_path, ydict, stale_glob):
+        try:
+            os.makedirs(cache_path.parent, exist_ok=True)
+            for stale in cache_path.parent.glob(stale_glob):  # the parses of the file's previous versions
+                stale.unlink()
+            tmp_path = cache_path.with_suffix(F'.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump(ydict, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # a read-only deploy just parses every time
+
+    def reload_if_changed(self):
+        """:return: True if the file changed and the new snapshot is in place"""
+        current = self.snapshot
+        if os.stat(self.yaml_path).st_mtime_ns == current.mtime:
+            return False
+        snapshot = self.load()
+        if snapshot.digest == current.digest:
+            current.mtime = snapshot.mtime  # touched, not changed
+            return False
+        self._snapshot = snapshot
+        for callback in self._reload_callbacks:
+            callback(self)
+        return True
+
+    def on_reload(self, callback):
+        """callback(yaml_helper) is called after a changed file is swapped in"""
+        self._reload_callbacks.append(callback)
+
+    def watch(self, interval=5.0):
+        """checks the file every interval seconds, in this process and in the workers forked from it"""
+        self._watch_interval = interval
+        if self._watcher is None or not self._watcher.is_alive():
+            self._watcher = threading.Thread(target=self._watch_loop, name=F'yaml-watch-{self.yaml_file}',
+                                             daemon=True)
+            self._watcher.start()
+
+    def _watch_loop(self):
+        stop = threading.Event()
+        while not stop.wait(self._watch_interval):
+            try:
+                self.reload_if_changed()
+            except Exception:
+                pass  # a half written or invalid file: keep the current snapshot, retry on the next check
+
+    def _after_fork(self):
+        # threads do not survive a fork; the lock may have been held by one of them
+        self._lock = threading.Lock()
+        self._watcher = None
+        if self._watch_interval:
+            self.watch(self._watch_interval)
 
     def path_get(self, ypath: str, ydict=None, opt_value=None):
-        path_dict = ydict or self.ydict
+        snapshot = self.snapshot
+        if ydict is None:
+            prefix = ''
+        else:
+            prefix = snapshot.prefixes.get(id(ydict))
+            if prefix is None:  # not a dict of this snapshot, e.g. one from before a reload
+                return self.walk_get(ypath, ydict, opt_value)
+
+        value = snapshot.index.get(F'{prefix}{ypath}')
+        if value is None:
+            if opt_value:
+                return opt_value
+            raise YAMLError(F'Can not find {ypath} in {self.yaml_file}')
+        return value
+
+    @classmethod
+    def walk_get(cls, ypath: str, ydict, opt_value=None):
+        path_dict = ydict
 
         for item in ypath.split("/"):
             value = path_dict.get(item)
@@ -0,0 +1,329 @@
+'''counters, gauges and fixed-bucket histograms kept in process memory, a file-backed store that
+aggregates them across the worker processes, and the Prometheus text format rendering'''
+
+import bisect
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class Metric:
+    """
+    - The values are kept per label values tuple, given in the order of label_names.
+    - A single lock per metric, held only for the dict update, keeps the recording cheap.
+    """
+    kind = None
+
+    def __init__(self, name, doc, label_names=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), self.copy_value(value)] for labels, value in self.values.items()]
+
+    @staticmethod
+    def copy_value(value):
+        return value
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+    def after_fork(self):
+        # the parent's lock may have been held by one of its other threads
+        self._lock = threading.Lock()
+        self.values = {}
+
+    def describe(self):
+        return {'kind': self.kind, 'doc': self.doc, 'label_names': list(self.label_names)}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    fixed buckets, so an observation is a bisect and two additions. A value is
+    [count per bucket (not cumulative)..., count above the last bucket, sum]
+    """
+    kind = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, doc, label_names=(), buckets=None):
+        super().__init__(name, doc, label_names)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+
+    def observe(self, value, labels=()):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[slot] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def copy_value(value):
+        return list(value)
+
+    def describe(self):
+        description = super().describe()
+        description['buckets'] = list(self.buckets)
+        return description
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        assert metric.name not in self.metrics, F'Metric {metric.name} is already registered'
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, label_names=()):
+        return self.register(Counter(name, doc, label_names))
+
+    def gauge(self, name, doc, label_names=()):
+        return self.register(Gauge(name, doc, label_names))
+
+    def histogram(self, name, doc, label_names=(), buckets=None):
+        return self.register(Histogram(name, doc, label_names, buckets))
+
+    def snapshot(self):
+        """{metric name: its describe() plus 'values': [[label values, value]]}, json serializable"""
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            snapshot[name] = metric.describe()
+            snapshot[name]['values'] = metric.snapshot()
+        return snapshot
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def after_fork(self):
+        for metric in self.metrics.values():
+            metric.after_fork()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def merge_snapshots(snapshots):
+    """
+    sums the counters and histograms of every snapshot, and the gauges of the live processes only
+    :param snapshots: [(pid, alive, snapshot)]
+    """
+    merged = {}
+    for pid, alive, snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if metric['kind'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(name, dict(metric, values={}))
+            for labels, value in metric['values']:
+                labels = tuple(labels)
+                current = target['values'].get(labels)
+                if current is None:
+                    target['values'][labels] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target['values'][labels] = [a + b for a, b in zip(current, value)]
+                else:
+                    target['values'][labels] = current + value
+    return merged
+
+
+def as_snapshot(merged):
+    """the reverse of merge_snapshots: a merged result back in the snapshot format, to be written to a file"""
+    return {name: dict(metric, values=[[list(labels), value] for labels, value in metric['values'].items()])
+            for name, metric in merged.items()}
+
+
+class FileStore:
+    """
+    - Every process writes a snapshot of its registry to <directory>/metrics_<pid>.json, at most once
+    per flush_interval seconds (maybe_flush is called after each recording), so the recording itself
+    never touches the disk.
+    - collect() merges the files of the other processes with the live registry of this one. The counters
+    and histograms of exited processes are kept, so the totals do not go back after a worker is replaced,
+    but their files are folded into one exited_metrics.json (see compact()), so the directory does not grow
+    with every recycled worker; their gauges are dropped.
+    """
+    file_prefix = 'metrics_'
+    exited_file = 'exited_metrics.json'
+    lock_file = 'metrics.lock'
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'flask_basic_metrics')
+        self.flush_interval = flush_interval
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, pid):
+        return os.path.join(self.directory, F'{self.file_prefix}{pid}.json')
+
+    def flush_due(self):
+        return time.monotonic() - self._flushed_at >= self.flush_interval
+
+    def maybe_flush(self, registry):
+        if self.flush_due():
+            self.flush(registry)
+
+    def flush(self, registry):
+        if not self._lock.acquire(blocking=False):
+            return  # another thread of this process is writing it
+        try:
+            self._flushed_at = time.monotonic()
+            self.write(self.path_for(os.getpid()), registry.snapshot())
+        finally:
+            self._lock.release()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._flushed_at = 0.0
+
+    def process_files(self):
+        """{pid: path} of the per-process files"""
+        files = {}
+        for path in glob.glob(os.path.join(self.directory, F'{self.file_prefix}*.json')):
+            files[int(os.path.basename(path)[len(self.file_prefix):-len('.json')])] = path
+        return files
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path) as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None  # removed or replaced under us
+
+    def write(self, path, snapshot):
+        tmp_path = F'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(snapshot, tmp_file)
+        os.replace(tmp_path, path)  # atomic, a reader never sees a partial file
+
+    def compact(self):
+        """
+        folds the files of the exited processes into exited_metrics.json and removes them. the processes
+        compact under a file lock, so a file is never folded twice
+        """
+        dead = {pid: path for pid, path in self.process_files().items() if not pid_alive(pid)}
+        if not dead:
+            return
+        exited_path = os.path.join(self.directory, self.exited_file)
+        with open(os.path.join(self.directory, self.lock_file), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshots = [(0, False, self.read(exited_path) or {})]
+            folded = []
+            for pid, path in dead.items():
+                snapshot = self.read(path)
+                if snapshot is not None:  # None: already folded by another process
+                    snapshots.append((pid, False, snapshot))
+                    folded.append(path)
+            if folded:
+                self.write(exited_path, as_snapshot(merge_snapshots(snapshots)))
+                for path in folded:
+                    os.remove(path)
+
+    def collect(self, registry):
+        self.compact()
+        my_pid = os.getpid()
+        snapshots = [(my_pid, True, registry.snapshot())]
+        exited = self.read(os.path.join(self.directory, self.exited_file))
+        if exited is not None:
+            snapshots.append((0, False, exited))
+        for pid, path in self.process_files().items():
+            if pid == my_pid:
+                continue
+            snapshot = self.read(path)
+            if snapshot is not None:
+                snapshots.append((pid, pid_alive(pid), snapshot))
+        return merge_snapshots(snapshots)
+
+    def clear(self):
+        """removes every process' file, e.g. when the server (re)starts"""
+        paths = glob.glob(os.path.join(self.directory, F'{self.file_prefix}*.json*'))
+        paths += glob.glob(os.path.join(self.directory, F'{self.exited_file}*'))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(label_names, labels, extra=()):
+    pairs = list(zip(label_names, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(F'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def render_prometheus(merged):
+    """the merged snapshot in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(F'# HELP {name} {metric["doc"]}')
+        lines.append(F'# TYPE {name} {metric["kind"]}')
+        label_names = metric['label_names']
+        for labels, value in sorted(metric['values'].items()):
+            if metric['kind'] != 'histogram':
+                lines.append(F'{name}{format_labels(label_names, labels)} {format_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + [float('inf')], value[:-1]):
+                cumulative += count
+                le = (('le', format_number(float(bound))),)
+                lines.append(F'{name}_bucket{format_labels(label_names, labels, le)} {cumulative}')
+            lines.append(F'{name}_sum{format_labels(label_names, labels)} {format_number(value[-1])}')
+            lines.append(F'{name}_count{format_labels(label_names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,135 @@
+'''the application's metrics and exception reporting. Monitor is used through its classmethods, the
+metrics live in this process and are shared with the other workers through the FileStore'''
+
+import logging
+import os
+import time
+
+from library.monitor.metrics import MetricsRegistry, FileStore, render_prometheus
+
+logger = logging.getLogger(__name__)
+
+
+class BaseTags:
+    """the label names of the request metrics, and tags for Monitor.exception()"""
+    ENDPOINT = 'endpoint'
+    METHOD = 'method'
+    STATUS = 'status'
+    EXCEPTION = 'exception'
+
+
+class Monitor:
+    """
+    - request_started() / request_finished() are called by APIEndpoint.on_call for every call, they record
+    the latency (a histogram per endpoint, for p95/p99 with histogram_quantile), the status codes, the
+    requests in flight and the request / response sizes.
+    - render() returns the metrics of all the workers in the Prometheus text format, for /metrics.
+    - add_collector() registers a callback setting gauges read from elsewhere (e.g. the connection pool's
+    state); the collectors run before each write of this worker's metrics and before render().
+    - configure() sets the directory the workers share; call it before the workers are forked.
+    """
+    registry = MetricsRegistry()
+    store = None
+    collectors = []
+
+    size_buckets = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+    requests = registry.counter(
+        'http_requests_total', 'Requests by endpoint, method and status code.',
+        (BaseTags.ENDPOINT, BaseTags.METHOD, BaseTags.STATUS))
+    latency = registry.histogram(
+        'http_request_duration_seconds', 'Time from the call to the response being built, by endpoint.',
+        (BaseTags.ENDPOINT,))
+    in_flight = registry.gauge(
+        'http_requests_in_flight', 'Requests being handled, by endpoint.', (BaseTags.ENDPOINT,))
+    request_size = registry.histogram(
+        'http_request_size_bytes', 'Request body sizes, by endpoint.', (BaseTags.ENDPOINT,), buckets=size_buckets)
+    response_size = registry.histogram(
+        'http_response_size_bytes', 'Response body sizes (not measured for streamed responses), by endpoint.',
+        (BaseTags.ENDPOINT,), buckets=size_buckets)
+    exceptions = registry.counter(
+        'app_exceptions_total', 'Exceptions reported through Monitor.exception, by type.', (BaseTags.EXCEPTION,))
+
+    @classmethod
+    def configure(cls, directory=None, flush_interval=1.0):
+        """
+        :param directory: where every worker writes its metrics, default <tmp>/flask_basic_metrics
+        :param flush_interval: seconds between the writes of a worker's metrics
+        """
+        cls.store = FileStore(directory, flush_interval)
+        return cls.store
+
+    @classmethod
+    def get_store(cls):
+        if cls.store is None:
+            cls.configure()
+        return cls.store
+
+    @classmethod
+    def add_collector(cls, callback):
+        """:param callback: called without arguments, sets its gauges"""
+        if callback not in cls.collectors:
+            cls.collectors.append(callback)
+
+    @classmethod
+    def run_collectors(cls):
+        for callback in cls.collectors:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning('metrics collector %s failed: %s', getattr(callback, '__qualname__', callback), e)
+
+    @classmethod
+    def maybe_flush(cls):
+        store = cls.get_store()
+        if store.flush_due():
+            cls.run_collectors()
+            store.flush(cls.registry)
+
+    @classmethod
+    def request_started(cls, endpoint):
+        cls.in_flight.inc((endpoint,))
+        return time.perf_counter()
+
+    @classmethod
+    def request_finished(cls, endpoint, method, status, started, request_bytes=None, response_bytes=None):
+        """
+        :param started: what request_started() returned
+        :param request_bytes: the request's content length, if it has a body
+        :param response_bytes: the response's content length, None for a streamed response
+        """
+        cls.latency.observe(time.perf_counter() - started, (endpoint,))
+        cls.in_flight.dec((endpoint,))
+        cls.requests.inc((endpoint, method, str(status)))
+        if request_bytes:
+            cls.request_size.observe(request_bytes, (endpoint,))
+        if response_bytes is not None:
+            cls.response_size.observe(response_bytes, (endpoint,))
+        cls.maybe_flush()
+
+    @classmethod
+    def exception(cls, title: str, e: Exception, msg: str = '', tags: list = None):
+        cls.exceptions.inc((type(e).__name__,))
+        logger.error('%s: %s %s tags=%s', title, e, msg, tags or [], exc_info=e)
+        cls.maybe_flush()
+
+    @classmethod
+    def render(cls):
+        store = cls.get_store()
+        cls.run_collectors()
+        store.flush(cls.registry)
+        return render_prometheus(store.collect(cls.registry))
+
+    @classmethod
+    def reset(cls):
+        cls.registry.reset()
+
+    @classmethod
+    def after_fork(cls):
+        """a forked worker starts from zero, the values it inherited are reported by its parent's file"""
+        cls.registry.after_fork()
+        if cls.store is not None:
+            cls.store.after_fork()
+
+
+os.register_at_fork(after_in_child=Monitor.after_fork)
@@ -11,15 +11,22 @@ class ObjectBroker:
         3. pooling
         4. object initiation
     - access to objects without having to import their modules (no circular references)
+    - objects built on first use, from the factory registered with set_factory(), once per process
     """
 
     def __init__(self):
         self._ob_dict = {}
+        self._factories = {}
+
+    def set_factory(self, key, factory):
+        self._factories[key] = factory
 
     def __setitem__(self, key, value):
         self._ob_dict[key] = value
 
     def __getitem__(self, key):
+        if key not in self._ob_dict and key in self._factories:
+            self._ob_dict[key] = self._factories[key]()
         return self._ob_dict[key]
 
     def __delitem__(self, key):
@@ -29,8 +36,10 @@ class ObjectBroker:
         self.__delitem__(key)
 
     def get(self, key):
+        if key not in self._ob_dict and key in self._factories:
+            return self[key]
         return self._ob_dict.get(key)
-        
+
     @property
     def flapp(self):  # Flask api
         return self['flapp']
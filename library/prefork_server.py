@@ -0,0 +1,202 @@
+'''a pre-forking WSGI server: the master loads the app once, binds the socket and forks the workers, which share
+the app copy-on-write and accept from the same socket. each worker serves one request at a time with the
+Werkzeug server'''
+
+import logging
+import os
+import random
+import signal
+import socket
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerServer(BaseWSGIServer):
+    """the Werkzeug server on the master's socket; counts the requests it served"""
+
+    def __init__(self, host, port, app, fd):
+        super().__init__(host, port, app, fd=fd)
+        self.socket.setblocking(False)  # the workers race for each connection, the losers go back to waiting
+        self.timeout = 1.0  # seconds handle_request() waits, so a stop request is seen without a connection
+        self.served = 0
+
+    def get_request(self):
+        conn, address = self.socket.accept()
+        conn.setblocking(True)
+        return conn, address
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        super().process_request(request, client_address)
+
+
+class PreforkServer:
+    """
+    - run() binds host:port, forks `workers` workers and keeps that many running: a worker that exits, or
+    is recycled after max_requests requests, is replaced.
+    - SIGTERM / SIGINT: graceful stop, the workers finish their request and exit; the ones still running
+    after graceful_timeout seconds are killed.
+    - SIGHUP: rolling reload, the workers are replaced one at a time by new forks of the master, so some are
+    always serving. The app code is not reloaded (it was loaded once, by the master), but the config the
+    master watches is.
+    - The hooks: before_fork() runs in the master before each fork, after_fork() in each new worker, and
+    worker_exit() in a worker about to exit.
+    """
+    stop_signals = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(self, app, host='127.0.0.1', port=5000, workers=None, max_requests=0, max_requests_jitter=0,
+                 graceful_timeout=30, backlog=128, before_fork=None, after_fork=None, worker_exit=None):
+        """
+        :param app: the WSGI app, loaded before run()
+        :param workers: number of worker processes, default the cpu count
+        :param max_requests: requests after which a worker is recycled, 0 to never recycle. limits the
+        memory a worker can creep up to
+        :param max_requests_jitter: up to this many requests added to each worker's max_requests, so the
+        workers are not all recycled at once
+        :param graceful_timeout: seconds the workers get to finish on a stop or reload
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.before_fork = before_fork
+        self.after_fork = after_fork
+        self.worker_exit = worker_exit
+        self.socket = None
+        self.children = set()  # the worker pids
+        self._stopping = False
+        self._reloading = False
+        self._worker_alive = True
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        self.socket = sock
+        self.port = sock.getsockname()[1]  # the one picked by the OS for port 0
+        return sock
+
+    # the master
+
+    def run(self):
+        if self.socket is None:
+            self.bind()
+        for signum in self.stop_signals:
+            signal.signal(signum, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        logger.info('master %d serving on %s:%d with %d workers', os.getpid(), self.host, self.port, self.workers)
+        try:
+            while not self._stopping:
+                self.reap()
+                if self._reloading:
+                    self._reloading = False
+                    self.rolling_reload()
+                while len(self.children) < self.workers and not self._stopping:
+                    self.spawn()
+                time.sleep(0.2)
+        finally:
+            self.stop_workers(set(self.children))
+            self.socket.close()
+        logger.info('master %d stopped', os.getpid())
+
+    def handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def handle_reload(self, signum, frame):
+        self._reloading = True
+
+    def spawn(self):
+        if self.before_fork is not None:
+            self.before_fork()
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+        exit_code = 0
+        try:
+            self.serve_worker()
+        except BaseException:
+            logger.exception('worker %d failed', os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)  # never back into the master's loop, nor its atexit handlers
+
+    def reap(self):
+        """forgets the workers that exited, returns their pids"""
+        exited = []
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            self.children.discard(pid)
+            exited.append(pid)
+            if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                logger.warning('worker %d exited with status %d', pid, status)
+        return exited
+
+    def wait_for(self, pids, timeout):
+        """waits up to timeout seconds for pids to exit, returns the ones still running"""
+        deadline = time.monotonic() + timeout
+        pending = set(pids) & self.children
+        while pending and time.monotonic() < deadline:
+            pending -= set(self.reap())
+            time.sleep(0.05)
+        return pending & self.children
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            self.kill(pid, signal.SIGTERM)
+        for pid in self.wait_for(pids, self.graceful_timeout):
+            logger.warning('worker %d did not stop in %ss, killed', pid, self.graceful_timeout)
+            self.kill(pid, signal.SIGKILL)
+        self.wait_for(pids, self.graceful_timeout)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.children.discard(pid)
+
+    def rolling_reload(self):
+        logger.info('master %d replacing its %d workers', os.getpid(), len(self.children))
+        for pid in list(self.children):
+            if self._stopping:
+                return
+            self.spawn()
+            self.stop_workers({pid})
+
+    # a worker
+
+    def serve_worker(self):
+        for signum in self.stop_signals:
+            signal.signal(signum, self.handle_worker_stop)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        self.children = set()
+        if self.after_fork is not None:
+            self.after_fork()
+
+        max_requests = self.max_requests + random.randint(0, self.max_requests_jitter) if self.max_requests else 0
+        server = WorkerServer(self.host, self.port, self.app, fd=self.socket.fileno())
+        try:
+            while self._worker_alive and not (max_requests and server.served >= max_requests):
+                server.handle_request()
+        finally:
+            if max_requests and server.served >= max_requests:
+                logger.info('worker %d recycled after %d requests', os.getpid(), server.served)
+            if self.worker_exit is not None:
+                self.worker_exit()
+            server.server_close()
+
+    def handle_worker_stop(self, signum, frame):
+        self._worker_alive = False
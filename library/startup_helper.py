@@ -0,0 +1,25 @@
+import time
+
+
+class StartupTimer:
+    """
+    - mark(name) closes a startup phase: the time since the previous mark (or since the timer was created)
+    is recorded under name.
+    - report() is the breakdown, in ms, in the order the phases ran.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = []  # [(name, seconds)]
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self):
+        return {
+            'total_ms': round((self._last - self.started) * 1000, 3),
+            'phases_ms': {name: round(seconds * 1000, 3) for name, seconds in self.phases},
+        }
@@ -1,12 +1,19 @@
-from flask_script import Manager, Shell
+import json
+import os
+import tempfile
+
+from flask_script import Manager, Shell, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
-from app.models.table_models import User, User_2
+from app.api.api import api_endpoint
+from app.models.table_models import User, User_2, models_by_name
+from app.service.importer import ModelImporter
+from app import AppFactory
 from flask_svc import app
+from library.object_broker import ob
 from sqla_stack.fl_sqla import sql_db
-from config import Config
 
-config = Config()
+config = ob.config  # the one the app was built with
 
 migrate = Migrate(app, sql_db)
 manager = Manager(app)
@@ -16,8 +23,171 @@ def make_shell_context():
     return dict(app=app, db=sql_db, user=User, user_2=User_2)
 
 
+class ImportCommand(Command):
+    """bulk loads a CSV or NDJSON file into a model: python manage.py import user_2 users.csv"""
+
+    option_list = (
+        Option('model', help=F'one of {list(models_by_name)}'),
+        Option('file', help='.csv, or NDJSON (one JSON object per line)'),
+        Option('--format', dest='fmt', default=None, help='csv or ndjson, by default from the file extension'),
+        Option('--workers', dest='workers', type=int, default=None, help='parsing processes, default cpu count'),
+        Option('--batch-size', dest='batch_size', type=int, default=5000, help='rows per INSERT and commit'),
+        Option('--rejects', dest='rejects_path', default=None, help='NDJSON file for the rejected records'),
+    )
+
+    def run(self, model, file, fmt, workers, batch_size, rejects_path):
+        if model not in models_by_name:
+            print(F'Unknown model: {model}. Expected one of {list(models_by_name)}')
+            return 1
+        importer = ModelImporter(models_by_name[model], batch_size=batch_size, workers=workers,
+                                 rejects_path=rejects_path)
+        report = importer.import_file(file, fmt=fmt)
+        report.pop('reject_samples')
+        print(json.dumps(report, indent=2))
+
+
+class BenchCommand(Command):
+    """
+    benchmarks the model hot paths and the endpoints against the configured database, e.g.
+    APP_YAML_CONFIG=bench.yaml python manage.py bench --concurrency 8 --baseline benchmarks/baseline.json
+    returns 1 when a case regressed against the baseline
+    """
+
+    option_list = (
+        Option('--rows', dest='rows', type=int, default=1000, help='rows seeded per table'),
+        Option('--ops', dest='ops', type=int, default=1000, help='operations per case'),
+        Option('--concurrency', dest='concurrency', type=int, default=4, help='threads running each case'),
+        Option('--cases', dest='names', default=None, help='comma separated case names, all by default'),
+        Option('--output', dest='output', default='bench_results.json', help='where the results are saved'),
+        Option('--baseline', dest='baseline', default=None, help='results to compare with'),
+        Option('--save-baseline', dest='save_baseline', default=None, help='also save the results as a baseline'),
+        Option('--tolerance', dest='tolerance', type=float, default=0.1, help='slowdown allowed, as a fraction'),
+        Option('--response-cache', dest='response_cache', action='store_true', default=False,
+               help='keep the endpoints response cache on for the http cases'),
+    )
+
+    def run(self, rows, ops, concurrency, names, output, baseline, save_baseline, tolerance, response_cache):
+        from benchmarks.cases import cases
+        from benchmarks.runner import BenchRunner, compare, load_report, save_report
+
+        runner = BenchRunner(app, rows=rows, ops=ops, concurrency=concurrency, response_cache=response_cache)
+        runner.seed()
+        try:
+            report = runner.run(cases, names=names.split(',') if names else None)
+        finally:
+            runner.cleanup()
+
+        save_report(report, output)
+        if save_baseline:
+            save_report(report, save_baseline)
+        print(json.dumps(report['cases'], indent=2))
+
+        if baseline:
+            regressions = compare(report, load_report(baseline), tolerance=tolerance)
+            for regression in regressions:
+                print(F'REGRESSION {regression}')
+            return 1 if regressions else 0
+
+
+class IndexesCommand(Command):
+    """
+    recommends indexes for the filter shapes the running workers queried (from the shared metrics directory),
+    with their EXPLAIN plans: python manage.py db indexes. --revision writes the recommended indexes, and the
+    declared __indexes__ the database lacks, as a migration to apply with python manage.py db upgrade
+    """
+
+    option_list = (
+        Option('--top', dest='top', type=int, default=10, help='number of the most frequent shapes looked at'),
+        Option('--min-count', dest='min_count', type=int, default=1, help='queries a shape needs'),
+        Option('--revision', dest='revision', action='store_true', default=False,
+               help='write a migration creating the indexes'),
+        Option('-m', '--message', dest='message', default='add indexes', help='the migration message'),
+        Option('-d', '--directory', dest='directory', default=None, help='the migrations directory'),
+    )
+
+    def run(self, top, min_count, revision, message, directory):
+        from app.models.index_advisor import IndexAdvisor
+
+        advisor = IndexAdvisor(models_by_name.values(), top=top, min_count=min_count)
+        recommendations = advisor.recommend()
+        missing = advisor.missing_declared()
+        print(json.dumps({'recommendations': recommendations, 'missing_declared': missing}, indent=2))
+
+        indexes = {index['name']: index for index in missing}
+        indexes.update((rec['index']['name'], rec['index']) for rec in recommendations if rec['index'])
+        if revision and indexes:
+            print(F'Wrote {advisor.write_revision(list(indexes.values()), message=message, directory=directory)}')
+
+
+class ServeCommand(Command):
+    """
+    the production server: python manage.py serve --workers 4 --max-requests 10000
+    the app is loaded and warmed up once, in the master, and shared copy-on-write by the forked workers.
+    kill -HUP <master pid> replaces the workers one at a time, kill -TERM stops them gracefully
+    """
+    server_defaults = {
+        'HOST': '127.0.0.1',
+        'PORT': 1111,
+        'WORKERS': 0,
+        'MAX_REQUESTS': 0,
+        'MAX_REQUESTS_JITTER': 0,
+        'GRACEFUL_TIMEOUT': 30,
+        'RESPONSE_CACHE': None,
+    }
+
+    option_list = (
+        Option('--host', dest='host', default=None),
+        Option('--port', dest='port', type=int, default=None),
+        Option('--workers', dest='workers', type=int, default=None, help='worker processes, 0 for the cpu count'),
+        Option('--max-requests', dest='max_requests', type=int, default=None,
+               help='requests after which a worker is replaced, 0 to never replace them'),
+        Option('--max-requests-jitter', dest='max_requests_jitter', type=int, default=None),
+        Option('--graceful-timeout', dest='graceful_timeout', type=int, default=None),
+    )
+
+    def run(self, **options):
+        from library.async_helper import loop_thread
+        from library.monitor.monitor import Monitor
+        from library.prefork_server import PreforkServer
+
+        server_ydict = config.yaml_config.ydict.get('Server') or {}
+        settings = {key.lower(): server_ydict.get(key, default) for key, default in self.server_defaults.items()}
+        settings.update((key, value) for key, value in options.items() if value is not None)
+        settings['workers'] = settings['workers'] or os.cpu_count() or 1
+
+        response_cache_path = settings.pop('response_cache') or os.path.join(
+            tempfile.gettempdir(), 'flask_basic_response_cache.sqlite')
+        if settings['workers'] > 1:  # every worker must see the invalidations of the others' writes
+            api_endpoint.share_response_cache(response_cache_path)
+        api_endpoint.response_cache.clear()  # the responses of a previous run
+
+        config.warm_up(app)  # the mappers, caches and imports are shared by the workers, not redone in each
+        Monitor.get_store().clear()  # the metrics of a previous run
+
+        def worker_exit():
+            loop_thread.stop()  # disposes of the async engine
+            Monitor.get_store().flush(Monitor.registry)
+
+        server = PreforkServer(app, before_fork=lambda: config.before_fork(app),
+                               after_fork=lambda: config.after_fork(app), worker_exit=worker_exit, **settings)
+        server.run()
+
+
+class StartupCommand(Command):
+    """prints how long each startup phase took: python manage.py startup (APP_STARTUP=EAGER to include the
+    DB checks, mapper configuration and prewarm)"""
+
+    def run(self):
+        print(json.dumps(AppFactory.startup_report(), indent=2))
+
+
 manager.add_command("shell", Shell(make_context=make_shell_context))
+MigrateCommand.add_command('indexes', IndexesCommand())
 manager.add_command('db', MigrateCommand)
+manager.add_command('import', ImportCommand())
+manager.add_command('bench', BenchCommand())
+manager.add_command('startup', StartupCommand())
+manager.add_command('serve', ServeCommand())
 
 if __name__ == '__main__':
     manager.run()
@@ -26,3 +196,5 @@ if __name__ == '__main__':
 # python manage.py db init
 # python manage.py db upgrade
 # python manage.py db migrate
+# python manage.py db indexes --revision
+# python manage.py serve --workers 4 --max-requests 10000  (main.py is the single process debug server)
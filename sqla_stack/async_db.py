@@ -0,0 +1,65 @@
+'''asyncio engine / sessions for the async BaseModel query helpers. the async drivers (aiomysql, or aiosqlite
+for a SQLite stand-in) are only imported when an async query runs'''
+
+import asyncio
+
+from sqlalchemy.engine import make_url
+
+from library.async_helper import loop_thread
+
+
+class AsyncDB:
+    """
+    - configure() is called by DataBaseConfig.initialize with the same url and pool options as sql_db.
+    - An asyncio engine's connections belong to the loop that opened them. The async queries run on the
+    process' one loop (see library.async_helper.LoopThread), so there is one engine, disposed of when the
+    loop stops. A query on another loop (e.g. asyncio.run in a script) replaces it.
+    - session() returns a new AsyncSession; sessions can not run concurrent queries, so every concurrent query
+    gets its own. expire_on_commit is off, the entities stay readable after the session is closed
+    """
+    async_drivers = {'mysql': 'mysql+aiomysql', 'sqlite': 'sqlite+aiosqlite'}
+
+    def __init__(self):
+        self.url = None
+        self.engine_options = {}
+        self._engine = None
+        self._engine_loop = None
+
+    def configure(self, db_url, **engine_options):
+        self.url = self.async_url(db_url)
+        self.engine_options = engine_options
+        self._engine = None
+        self._engine_loop = None
+        loop_thread.on_shutdown(self.dispose)
+
+    @classmethod
+    def async_url(cls, db_url):
+        url = make_url(db_url)
+        backend = url.get_backend_name()
+        if backend not in cls.async_drivers:
+            raise RuntimeError(F'No async driver for {backend}. Supported: {list(cls.async_drivers)}')
+        return url.set(drivername=cls.async_drivers[backend])
+
+    def engine(self):
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        assert self.url is not None, 'AsyncDB.configure() must be called first'
+        loop = asyncio.get_running_loop()
+        if self._engine is None or self._engine_loop is not loop:
+            # a different loop: the one the engine was opened on is gone (e.g. with a fork) or is not running
+            self._engine = create_async_engine(self.url, **self.engine_options)
+            self._engine_loop = loop
+        return self._engine
+
+    def session(self):
+        from sqlalchemy.ext.asyncio import AsyncSession
+
+        return AsyncSession(self.engine(), expire_on_commit=False)
+
+    async def dispose(self):
+        engine, self._engine, self._engine_loop = self._engine, None, None
+        if engine is not None:
+            await engine.dispose()
+
+
+async_db = AsyncDB()
@@ -1,12 +1,64 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
 from sqlalchemy import *
+from sqlalchemy import event, orm
 
 
-sql_db = SQLAlchemy()  # here we are initializng the sql db using sql alchemy
+class RoutingSession(SignallingSession):
+    """SignallingSession that honours an explicit bind, e.g. session.execute(..., bind_arguments={'bind': engine})
+    used to send reads to a replica (see sqla_stack.replicas)
+    - has_writes() tells whether the session holds anything a rollback would lose: pending changes, or writes
+    already sent in its open transaction (a flush, a Core INSERT / UPDATE / DELETE)"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        return super().get_bind(mapper=mapper, clause=clause)
+
+    def has_writes(self):
+        return bool(self.new or self.dirty or self.deleted or self.info.get('wrote'))
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _executed(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def _transaction_ended(session):
+    session.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine_callbacks = []  # callables(sa_url), called before each engine is created
+
+    def before_engine(self, callback):
+        if callback not in self.engine_callbacks:
+            self.engine_callbacks.append(callback)
+
+    def create_engine(self, sa_url, engine_opts):
+        for callback in self.engine_callbacks:
+            callback(sa_url)
+        return super().create_engine(sa_url, engine_opts)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+sql_db = RoutingSQLAlchemy()  # here we are initializng the sql db using sql alchemy
 mg = Migrate()
 
 from sqlalchemy import MetaData, create_engine
 from sqlalchemy_utils import database_exists, create_database
 
-meta = MetaData
\ No newline at end of file
+meta = MetaData
@@ -0,0 +1,85 @@
+'''a QueuePool that keeps checkout metrics, used as the poolclass of the app's engines'''
+
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0  # seconds spent waiting for a connection
+        self.wait_max = 0.0
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def as_dict(self):
+        return {
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_total_ms': round(self.wait_total * 1000, 3),
+            'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+            'wait_max_ms': round(self.wait_max * 1000, 3),
+        }
+
+
+class MonitoredQueuePool(QueuePool):
+    """
+    QueuePool that times every checkout (including the connect of a new connection)
+    - metrics() reports the pool's size, checked-out and overflow connections plus the checkout counters
+    - a recreate() (engine.dispose()) keeps the same counters
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stats = kwargs.pop('stats', None) or PoolStats()
+        super().__init__(*args, **kwargs)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - started)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def metrics(self):
+        metrics = {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+        }
+        metrics.update(self.stats.as_dict())
+        return metrics
+
+
+def prewarm(engine, connections):
+    """opens `connections` connections at once and returns them to the pool, so the first requests
+    do not pay for the connects"""
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(engine.connect())
+    finally:
+        for conn in opened:
+            conn.close()
+    return len(opened)
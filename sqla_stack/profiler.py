@@ -0,0 +1,158 @@
+'''per-request SQL profiling: every statement a request runs is timed, repeated statements (the same sql with
+different parameters, the N+1 pattern of by_prop_val / chk_and_create loops) are counted, and the totals are
+reported to the Monitor, labelled with the endpoint name'''
+
+import json
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from flask import g as flask_g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from library.monitor.monitor import Monitor, BaseTags
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfile:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.statements = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.total += seconds
+        self.statements[statement] += 1
+        if seconds > self.slowest:
+            self.slowest = seconds
+            self.slowest_statement = statement
+
+    def repeated(self, threshold):
+        """[(statement, times)] run at least threshold times, the most repeated first"""
+        return [(statement, times) for statement, times in self.statements.most_common() if times >= threshold]
+
+    def summary(self, threshold, sql_chars=200):
+        """:param sql_chars: the statements are cut to this length, the summary goes in a response header"""
+        return {
+            'statements': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'slowest_ms': round(self.slowest * 1000, 3),
+            'slowest': (self.slowest_statement or '')[:sql_chars],
+            'repeated': [{'times': times, 'sql': statement[:sql_chars]}
+                         for statement, times in self.repeated(threshold)],
+        }
+
+
+class SQLProfiler:
+    """
+    - install() adds cursor execute listeners to every Engine (the primary, the replicas and the async
+    engines' sync side) and before / after_request hooks to the app. Statements run outside a request are ignored.
+    - The request's profile is kept in a context variable, not in flask_g, so the statements of an async
+    endpoint, run on the process' loop thread and in the async engine's greenlets, are counted too (the
+    context is copied to both).
+    - A statement run n_plus_one times or more in one request is reported as a suspected N+1, a request whose
+    statements took more than slow_request_ms in total as a slow request; both are logged and counted.
+    - With debug_header, the request's profile is returned as JSON in the X-SQL-Profile response header.
+    """
+    header_name = 'X-SQL-Profile'
+    ignored_statements = frozenset(['SELECT 1'])  # liveness checks, e.g. the replica health checks
+
+    statements_per_request = Monitor.registry.histogram(
+        'db_statements_per_request', 'SQL statements run by a request, by endpoint.', (BaseTags.ENDPOINT,),
+        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+    statement_time = Monitor.registry.histogram(
+        'db_request_duration_seconds', 'Time a request spent in SQL statements, by endpoint.', (BaseTags.ENDPOINT,))
+    slow_statements = Monitor.registry.histogram(
+        'db_slowest_statement_seconds', 'The slowest SQL statement of a request, by endpoint.', (BaseTags.ENDPOINT,))
+    n_plus_one_requests = Monitor.registry.counter(
+        'db_n_plus_one_total', 'Requests that repeated a statement n_plus_one times or more, by endpoint.',
+        (BaseTags.ENDPOINT,))
+    slow_requests = Monitor.registry.counter(
+        'db_slow_requests_total', 'Requests whose SQL took more than slow_request_ms, by endpoint.',
+        (BaseTags.ENDPOINT,))
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_request_ms = 500
+        self.n_plus_one = 5
+        self.debug_header = False
+        self._listening = False
+        self._profile = ContextVar('sql_profile', default=None)
+
+    def configure(self, enabled=True, slow_request_ms=500, n_plus_one=5, debug_header=False):
+        """
+        :param enabled: False leaves the statements unrecorded
+        :param slow_request_ms: total statement time of a slow request
+        :param n_plus_one: times the same statement runs in a request before it is a suspected N+1
+        :param debug_header: return the request's profile in the X-SQL-Profile header
+        """
+        self.enabled = enabled
+        self.slow_request_ms = slow_request_ms
+        self.n_plus_one = n_plus_one
+        self.debug_header = debug_header
+
+    def install(self, flapp):
+        if not self._listening:  # the Engine class listeners are process wide, they are added once
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            self._listening = True
+        if self.finish_request not in flapp.after_request_funcs.get(None, []):
+            flapp.before_request(self.start_request)
+            flapp.after_request(self.finish_request)
+
+    def start_request(self):
+        self._profile.set(RequestProfile() if self.enabled else None)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('profile_started')
+        if not started:
+            return
+        seconds = time.perf_counter() - started.pop()
+        profile = self._profile.get()
+        if profile is not None and statement not in self.ignored_statements:
+            profile.record(statement, seconds)
+
+    def current(self):
+        """the profile of the request this thread is serving, None outside a request"""
+        return self._profile.get()
+
+    def finish_request(self, response):
+        profile = self.current()
+        self._profile.set(None)
+        if profile is None or not profile.count:
+            return response
+        endpoint = flask_g.get('my_func_name') or 'unknown'
+        labels = (endpoint,)
+        self.statements_per_request.observe(profile.count, labels)
+        self.statement_time.observe(profile.total, labels)
+        self.slow_statements.observe(profile.slowest, labels)
+
+        repeated = profile.repeated(self.n_plus_one)
+        if repeated:
+            self.n_plus_one_requests.inc(labels)
+            statement, times = repeated[0]
+            logger.warning('%s: suspected N+1, %d statements, ran %d times: %s', endpoint, profile.count, times,
+                           statement)
+        if profile.total * 1000 > self.slow_request_ms:
+            self.slow_requests.inc(labels)
+            logger.warning('%s: slow request, %d statements took %.1f ms, the slowest %.1f ms: %s', endpoint,
+                           profile.count, profile.total * 1000, profile.slowest * 1000, profile.slowest_statement)
+
+        if self.debug_header:
+            summary = profile.summary(self.n_plus_one)
+            response.headers[self.header_name] = json.dumps(summary).replace('\n', ' ')
+        return response
+
+
+sql_profiler = SQLProfiler()
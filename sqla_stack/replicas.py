@@ -0,0 +1,159 @@
+'''routes the BaseModel reads to read replicas, writes always go to the primary (the default bind)'''
+
+import itertools
+import os
+import threading
+import time
+
+from flask import g as flask_g, has_app_context
+from sqlalchemy import text
+
+from sqla_stack.fl_sqla import sql_db
+
+
+class ReplicaRouter:
+    """
+    - configure() registers each replica url as a SQLALCHEMY_BINDS entry named replica_<n>.
+    - read_bind() picks the engine for a read: a healthy replica, round-robin or least-loaded (fewest
+    checked-out connections), or None for the primary.
+    - After mark_write(), reads in the same app context (request) stay on the primary, so a request reads
+    its own writes regardless of the replication lag.
+    - A replica is taken out of rotation for retry_after seconds when a read on it fails (mark_failed), or
+    when the periodic health check finds it down or lagging more than max_lag seconds. The health check runs
+    every health_interval seconds in a daemon thread (one per process, started by the first read), so a
+    request never waits for the connect timeout of a dead replica.
+    """
+    strategies = ('round_robin', 'least_loaded')
+
+    def __init__(self):
+        self.bind_names = []
+        self.strategy = 'round_robin'
+        self.max_lag = None
+        self.retry_after = 30
+        self.health_interval = 10
+        self._down_until = {}  # bind name: time it is retried
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._app = None
+        self._checker = None
+        self._checker_pid = None
+        self._stop = threading.Event()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # the lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.bind_names)
+
+    def configure(self, flapp, replica_urls, strategy='round_robin', max_lag=None, retry_after=30,
+                  health_interval=10):
+        """
+        :param flapp: its SQLALCHEMY_BINDS get a replica_<n> entry per url
+        :param replica_urls: one sqlalchemy url per replica
+        :param strategy: 'round_robin' or 'least_loaded'
+        :param max_lag: seconds of replication lag before a replica is skipped, None to not check the lag
+        :param retry_after: seconds a failed replica stays out of rotation
+        :param health_interval: seconds between health checks
+        """
+        assert strategy in self.strategies, F'Unknown replica strategy {strategy}. Expected one of {self.strategies}'
+        binds = flapp.config.setdefault('SQLALCHEMY_BINDS', {})
+        self.bind_names = []
+        for num, url in enumerate(replica_urls or []):
+            name = F'replica_{num}'
+            binds[name] = url
+            self.bind_names.append(name)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.retry_after = retry_after
+        self.health_interval = health_interval
+        self._down_until = {}
+        self._app = flapp
+
+    def mark_write(self):
+        if self.enabled and has_app_context():
+            flask_g.db_wrote = True
+
+    def read_bind(self):
+        """the replica engine for the next read, or None to read from the primary"""
+        if not self.enabled or (has_app_context() and flask_g.get('db_wrote')):
+            return None
+        self.start_health_checks()
+
+        healthy = self.healthy_binds()
+        if not healthy:
+            return None
+        if self.strategy == 'least_loaded':
+            engines = [sql_db.get_engine(bind=name) for name in healthy]
+            return min(engines, key=lambda engine: getattr(engine.pool, 'checkedout', lambda: 0)())
+        with self._lock:
+            num = next(self._counter)
+        return sql_db.get_engine(bind=healthy[num % len(healthy)])
+
+    def healthy_binds(self):
+        now = time.monotonic()
+        return [name for name in self.bind_names if self._down_until.get(name, 0) <= now]
+
+    def mark_failed(self, engine):
+        for name in self.bind_names:
+            if sql_db.get_engine(bind=name) is engine:
+                self._down_until[name] = time.monotonic() + self.retry_after
+
+    def start_health_checks(self):
+        if self._checker_pid == os.getpid() and self._checker.is_alive():
+            return
+        with self._lock:
+            if self._checker_pid == os.getpid() and self._checker.is_alive():
+                return
+            # threads do not survive a fork, a forked worker starts its own
+            self._stop = threading.Event()
+            self._checker = threading.Thread(target=self._health_loop, args=(self._stop,), name='replica-health',
+                                             daemon=True)
+            self._checker_pid = os.getpid()
+            self._checker.start()
+
+    def stop_health_checks(self):
+        self._stop.set()
+
+    def _health_loop(self, stop):
+        while not stop.is_set():
+            try:
+                with self._app.app_context():
+                    self.check_health()
+            except Exception:
+                pass  # e.g. the app is being torn down; retried on the next interval
+            stop.wait(self.health_interval)
+
+    def check_health(self):
+        for name in self.bind_names:
+            engine = sql_db.get_engine(bind=name)
+            try:
+                lag = self.replication_lag(engine)
+            except Exception:
+                lag = None
+            if lag is None or (self.max_lag is not None and lag > self.max_lag):
+                self._down_until[name] = time.monotonic() + self.retry_after
+            else:
+                self._down_until.pop(name, None)
+
+    @classmethod
+    def replication_lag(cls, engine):
+        """seconds behind the primary, 0 for a database that is not a MySQL replica (e.g. a SQLite stand-in),
+        None when replication is stopped"""
+        with engine.connect() as conn:
+            if engine.dialect.name != 'mysql':
+                conn.execute(text('SELECT 1'))
+                return 0
+            status = conn.execute(text('SHOW SLAVE STATUS')).mappings().first()
+            if status is None:
+                return 0
+            return status['Seconds_Behind_Master']
+
+    def status(self):
+        now = time.monotonic()
+        return {name: 'up' if self._down_until.get(name, 0) <= now else 'down' for name in self.bind_names}
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,80 @@
+'''a request scoped unit of work: the BaseModel writes inside it share one transaction and one commit'''
+
+from flask import g as flask_g
+
+from sqla_stack.fl_sqla import sql_db
+
+
+class UnitOfWork:
+    """
+    - Inside `with UnitOfWork():`, or an endpoint declared with on_call(unit_of_work=True), BaseModel.save,
+    update, delete_me, bulk_save and bulk_upsert do not commit. The session flushes everything at once when
+    the block ends, with a single commit; an exception rolls all of it back.
+    - The entity cache invalidation and the write listeners wait for that commit too. On a rollback the
+    invalidations (after_commit) run as well, an entry cached while the unit was open could hold its
+    rolled-back values; the write listeners do not, nothing was written.
+    - A unit of work opened inside another one joins it.
+    - expire_on_commit=False keeps the committed entities' values, so reading them afterwards (e.g. to
+    serialize the response) does not reload them. Values set by the database (server defaults, onupdate)
+    are then not refreshed.
+    """
+
+    def __init__(self, expire_on_commit=True):
+        self.expire_on_commit = expire_on_commit
+        self.after_commit = []
+        self.written_models = []
+        self.discarded = False
+        self._joined = False
+
+    @classmethod
+    def current(cls):
+        return flask_g.get('unit_of_work')
+
+    def __enter__(self):
+        if self.current() is not None:
+            self._joined = True
+            return self.current()
+        flask_g.unit_of_work = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._joined:
+            return False
+        flask_g.unit_of_work = None
+        if exc_type is not None or self.discarded:
+            self.rollback()
+            return False
+        self.commit()
+        return False
+
+    def defer(self, model, after_commit=None):
+        """called by the BaseModel writes instead of committing"""
+        if after_commit is not None:
+            self.after_commit.append(after_commit)
+        if model not in self.written_models:
+            self.written_models.append(model)
+
+    def discard(self):
+        """rolls back instead of committing at the end, e.g. when the endpoint returns an error response"""
+        self.discarded = True
+
+    def commit(self):
+        session = sql_db.session()
+        expire_on_commit = session.expire_on_commit
+        session.expire_on_commit = self.expire_on_commit
+        try:
+            session.commit()
+        except Exception as e:
+            self.rollback()
+            raise e
+        finally:
+            session.expire_on_commit = expire_on_commit
+        for after_commit in self.after_commit:
+            after_commit()
+        for model in self.written_models:
+            model.notify_write()
+
+    def rollback(self):
+        sql_db.session.rollback()
+        for after_commit in self.after_commit:
+            after_commit()
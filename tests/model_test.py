@@ -1,3 +1,4 @@
+import time
 import unittest
 from flask_svc import app
 from datetime import datetime
@@ -20,3 +21,386 @@ class UserTests(unittest.TestCase):
         usr = User()
         result = usr.by_name('Mathew Perrera')
         print(result.name)
+
+    def test_statement_cache(self):
+        from app.models.table_models import User
+        cache = User.statement_cache()
+        User.by_name('Mathew Perrera')
+        hits = cache.hits
+        User.by_name('Perry')
+        self.assertEqual(cache.hits, hits + 1)
+
+    def test_bulk_save(self):
+        from app.models.table_models import User_2
+        User_2.extract_sample_values_from_sample_data()
+        counts = User_2.extract_sample_values_from_sample_data()
+        self.assertEqual(counts['inserted'], 0)
+
+    def test_iter_all(self):
+        from app.models.table_models import User
+        streamed = sum(1 for _ in User.iter_all(chunk_size=2))
+        self.assertEqual(streamed, User.count())
+
+    def test_to_json_many(self):
+        import json
+        from app.models.table_models import User
+        users = User.run_query_all()
+        columnar = json.loads(User.to_json_many(users, columnar=True))
+        self.assertEqual(columnar['count'], len(users))
+        self.assertEqual(json.loads(User.to_json_many(users[:1])), User.to_dict_many(users[:1]))
+
+    def test_serialize_unsupported_type(self):
+        from decimal import Decimal
+        from library.api_tools import APIEndpoint
+        self.assertEqual(APIEndpoint.serialize({'on': datetime(2021, 1, 2)}), b'{"on":"2021-01-02T00:00:00"}')
+        with self.assertRaises(TypeError):
+            APIEndpoint.serialize({'amount': Decimal('1.5')})
+
+    def test_readonly_rows(self):
+        from app.models.table_models import User
+        for age in (30, 31):
+            User(name='Readonly Row', age=age).save()
+        try:
+            rows = User.list_by_query({'name': 'Readonly Row'}, columns=['pid', 'name'])
+            entities = User.list_by_query({'name': 'Readonly Row'})
+            self.assertEqual(len(rows), 2)
+            self.assertEqual([row.pid for row in rows], [entity.pid for entity in entities])
+            self.assertEqual(len(rows[0]), 2)
+        finally:
+            User.delete_where([User.name == 'Readonly Row'])
+
+    def test_unit_of_work(self):
+        from app.models.table_models import User
+        from sqla_stack.unit_of_work import UnitOfWork
+        count = User.count()
+        try:
+            with self.assertRaises(RuntimeError):
+                with UnitOfWork():
+                    User(name='Perry', age=30).save()
+                    raise RuntimeError('rolled back')
+            self.assertEqual(User.count(), count)
+            with UnitOfWork(expire_on_commit=False):
+                user = User(name='Perry', age=30).save()
+            self.assertEqual(User.count(), count + 1)
+            self.assertEqual(user.__dict__.get('age'), 30)
+        finally:
+            User.delete_where([User.name == 'Perry'])
+
+    def test_unit_of_work_rollback_uncaches(self):
+        from app.models.table_models import User
+        from sqla_stack.unit_of_work import UnitOfWork
+        cache = User.enable_entity_cache()
+        try:
+            user = User(name='Perry', age=30).save()
+            key = User.entity_cache_key('pid', user.pid)
+            with self.assertRaises(RuntimeError):
+                with UnitOfWork():
+                    user.age = 31
+                    user.save()
+                    # e.g. another worker reading the flushed row while the unit is open
+                    cache.set(key, dict(cache.get(key) or {'pid': user.pid, 'name': 'Perry'}, age=31))
+                    raise RuntimeError('rolled back')
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(User.by_pid(user.pid).age, 30)
+        finally:
+            User.disable_entity_cache()
+            User.delete_where([User.name == 'Perry'])
+
+    def test_update_delete_where(self):
+        from app.models.table_models import User_2
+        User_2.bulk_save([{'name_2': 'purge', 'age_2': num} for num in range(5)])
+        self.assertEqual(User_2.update_where({'name_2': 'purge'}, {'age_2': 99}, chunk_size=2), 5)
+        self.assertEqual(User_2.delete_where([User_2.name_2 == 'purge', User_2.age_2 == 99]), 5)
+        self.assertFalse(User_2.exists({'name_2': 'purge'}))
+
+    def test_by_pids(self):
+        from app.models.table_models import User
+        pids = [user.pid for user in User.run_query_all()]
+        found = User.by_pids(pids + pids[:1] + [None], chunk_size=2)
+        self.assertEqual(sorted(found), sorted(pids))
+
+    def test_index_advisor(self):
+        from app.models.table_models import User_2
+        from app.models.index_advisor import IndexAdvisor
+        User_2.by_name_and_age('Perry', 30, check_only=True)
+        advisor = IndexAdvisor([User_2])
+        shapes = [(shape['keys'], shape['order_by']) for shape in advisor.observed_shapes()]
+        self.assertIn((('age_2', 'name_2'), ''), shapes)
+        indexes = advisor.declared_indexes(User_2)
+        self.assertEqual(advisor.covering_index(indexes, ('age_2', 'name_2'), ''), 'ix_User_2_name_2_age_2')
+        self.assertIsNone(advisor.covering_index(indexes, ('age_2',), 'name_2'))
+
+    def test_entity_cache_keeps_pending_changes(self):
+        from app.models.table_models import User
+        User.enable_entity_cache()
+        try:
+            pid = User(name='Cached', age=10).save().pid
+            User.by_pid(pid)  # fills the cache
+            user = User.by_pid(pid)
+            user.age = 99
+            self.assertIs(User.by_pid(pid), user)
+            self.assertEqual(user.age, 99)
+            user.save()
+            self.assertEqual(User.by_pid(pid).age, 99)
+        finally:
+            User.disable_entity_cache()
+
+    def test_entity_cache_skips_uncommitted_rows(self):
+        from app.models.table_models import User
+        from sqla_stack.fl_sqla import sql_db
+        from sqla_stack.unit_of_work import UnitOfWork
+        cache = User.enable_entity_cache()
+        try:
+            pid = User(name='Cached', age=10).save().pid
+            key = User.entity_cache_key('pid', pid)
+            with self.assertRaises(RuntimeError):
+                with UnitOfWork():
+                    User.by_pid(pid).age = 77
+                    User.by_pid(pid)
+                    raise RuntimeError('rolled back')
+            self.assertIsNone(cache.get(key))
+            user = User.by_pid(pid)  # a clean session, cached
+            self.assertEqual(cache.get(key)['age'], 10)
+            cache.delete(key)
+            user.age = 78
+            User.by_pid(pid)  # autoflushed, not committed
+            self.assertIsNone(cache.get(key))
+            sql_db.session.rollback()
+            self.assertEqual(User.by_pid(pid).age, 10)
+        finally:
+            User.disable_entity_cache()
+            User.delete_where([User.name == 'Cached'])
+
+    def test_entity_cache_invalidation(self):
+        from app.models.table_models import User
+        from sqla_stack.fl_sqla import sql_db
+        cache = User.enable_entity_cache()
+        try:
+            user = User(name='Cached', age=10).save()
+            pid = user.pid
+            key = User.entity_cache_key('pid', pid)
+            User.by_pid(pid)
+            user.update({'age': 11})
+            self.assertIsNone(cache.get(key))
+            User.by_pid(pid)
+            User.update_where({'pid': pid}, {'age': 12})
+            self.assertIsNone(cache.get(key))
+            sql_db.session.expunge_all()
+            self.assertEqual(User.by_pid(pid).age, 12)
+            User.by_pid(pid).delete_me()
+            self.assertIsNone(cache.get(key))
+            self.assertIsNone(User.by_pid(pid, check_only=True))
+        finally:
+            User.disable_entity_cache()
+
+    def test_sqlite_cache_replaces_tags(self):
+        import os
+        import tempfile
+        from library.cache_helper import SQLiteCache
+        cache = SQLiteCache(os.path.join(tempfile.mkdtemp(), 'cache.sqlite'), max_size=10)
+        cache.set('counts', 1, tags=['User'])
+        cache.set('counts', 2, tags=['User_2'])
+        cache.invalidate_tag('User')
+        self.assertEqual(cache.get('counts'), 2)
+        for num in range(20):
+            cache.set(F'key_{num}', num)
+        self.assertEqual(cache.size(), 10)
+
+    def test_sqlite_cache_batches_use_times(self):
+        import os
+        import tempfile
+        from library.cache_helper import SQLiteCache
+        cache = SQLiteCache(os.path.join(tempfile.mkdtemp(), 'cache.sqlite'), max_size=3)
+        cache.touch_interval = 0.05
+        for num in range(3):
+            cache.set(F'key_{num}', num)
+        changes = cache._conn().total_changes
+        self.assertEqual(cache.get('key_0'), 0)  # used within touch_interval, no write
+        self.assertEqual(cache._conn().total_changes, changes)
+        time.sleep(0.1)
+        self.assertEqual(cache.get('key_0'), 0)  # touched, the use time is written in a batch
+        cache.set('key_3', 3)
+        cache.evict()
+        self.assertEqual(cache.get('key_0'), 0)
+        self.assertIsNone(cache.get('key_1'))
+
+    def test_update_delete_where_like(self):
+        from app.models.table_models import User_2
+        User_2.bulk_save([{'name_2': F'zz_like_{num}', 'age_2': num} for num in range(3)])
+        entity = User_2.by_prop_val('name_2', 'zz_like_0')
+        self.assertEqual(User_2.update_where([User_2.name_2.like('zz_like%')], {'age_2': 42}), 3)
+        self.assertEqual(entity.age_2, 42)
+        self.assertEqual(User_2.delete_where([User_2.name_2.like('zz_like%')]), 3)
+        self.assertFalse(User_2.exists({'name_2': 'zz_like_1'}))
+
+    def test_user_delete_unlinks_users_2(self):
+        from app.models.table_models import User, User_2
+        user = User(name='Parent', age=50).save()
+        try:
+            for num in range(2):
+                User_2(name_2=F'child_{num}', age_2=num, user_key=user.pid).save()
+            children = User_2.list_by_query({'user_key': user.pid}, eager=('user',))
+            self.assertEqual([child.__dict__['user'] for child in children], [user, user])
+            user.delete_me()
+            children = User_2.list_by_query({'name_2': 'child_0'}) + User_2.list_by_query({'name_2': 'child_1'})
+            self.assertTrue(children)
+            self.assertTrue(all(child.user_key is None for child in children))
+        finally:
+            User_2.delete_where([User_2.name_2.in_(['child_0', 'child_1'])])
+            User.delete_where([User.name == 'Parent'])
+
+    def test_replica_failover(self):
+        from app.models.table_models import User
+        from sqla_stack.replicas import replica_router
+        count = User.count()
+        replica_router.configure(app, ['sqlite:////nonexistent_dir/replica.db'], health_interval=3600)
+        try:
+            self.assertEqual(User.count(), count)  # the failed replica read is retried on the primary
+            self.assertEqual(replica_router.status(), {'replica_0': 'down'})
+            self.assertIsNone(replica_router.read_bind())
+            replica_router.configure(app, ['sqlite:////nonexistent_dir/replica.db'], health_interval=3600)
+            replica_router.check_health()
+            self.assertEqual(replica_router.healthy_binds(), [])
+        finally:
+            replica_router.stop_health_checks()
+            replica_router.configure(app, [])
+            app.config['SQLALCHEMY_BINDS'].pop('replica_0')
+
+    def test_metrics_store_folds_exited_workers(self):
+        import os
+        import tempfile
+        from library.monitor.metrics import FileStore, MetricsRegistry
+        registry = MetricsRegistry()
+        requests = registry.counter('test_requests', 'requests', ('code',))
+        store = FileStore(tempfile.mkdtemp())
+        for _ in range(3):
+            pid = os.fork()
+            if pid == 0:
+                registry.reset()
+                requests.inc(('200',), 2)
+                store.flush(registry)
+                os._exit(0)
+            os.waitpid(pid, 0)
+        requests.inc(('200',))
+        self.assertEqual(store.collect(registry)['test_requests']['values'], {('200',): 7})
+        self.assertEqual(sorted(os.listdir(store.directory)), [FileStore.exited_file, FileStore.lock_file])
+        self.assertEqual(store.collect(registry)['test_requests']['values'], {('200',): 7})
+
+    def test_pool_gauges(self):
+        from sqlalchemy import create_engine
+        from app.models import DataBaseConfig
+        from library.monitor.monitor import Monitor
+        from sqla_stack.pool import MonitoredQueuePool
+        engine = create_engine('sqlite://', poolclass=MonitoredQueuePool, pool_size=2)
+        with engine.connect():
+            DataBaseConfig.export_pool_metrics(engine.pool)
+        self.assertEqual(DataBaseConfig.pool_connections.values[('checked_out',)], 1)
+        self.assertEqual(DataBaseConfig.pool_checkouts.values[()], 1)
+        self.assertIn('db_pool_connections{state="checked_out"}', Monitor.render())
+        engine.dispose()
+
+    def test_replica_failover_keeps_changes(self):
+        from app.models.table_models import User
+        from sqla_stack.fl_sqla import sql_db
+        from sqla_stack.replicas import replica_router
+        user = User(name='Failover', age=1).save()
+        replica_router.configure(app, ['sqlite:////nonexistent_dir/replica.db'], health_interval=3600)
+        try:
+            user.age = 42
+            User.count()  # a session with changes reads from the primary
+            sql_db.session.flush()
+            User.count()  # flushed, not committed: the primary too, never rolled back
+            self.assertEqual(user.age, 42)
+            user.save()
+            sql_db.session.expire_all()
+            self.assertEqual(User.by_pid(user.pid).age, 42)
+        finally:
+            replica_router.stop_health_checks()
+            replica_router.configure(app, [])
+            app.config['SQLALCHEMY_BINDS'].pop('replica_0')
+            User.delete_where([User.name == 'Failover'])
+
+    def test_import_csv_body(self):
+        import json
+        from app.models.table_models import User_2
+        body = 'name_2,age_2\nimported,1\nimported,2,extra\n'
+        try:
+            response = app.test_client().post('/api/v1/import/user_2', data=body, content_type='text/csv')
+            self.assertEqual(response.status_code, 200, response.data)
+            report = json.loads(response.data)
+            self.assertEqual((report['rows'], report['inserted'], report['rejected']), (2, 1, 1))
+            self.assertEqual(report['reject_samples'][0]['error'], '1 more fields than the header')
+        finally:
+            User_2.delete_where([User_2.name_2 == 'imported'])
+
+    def test_response_cache_etag(self):
+        import json
+        from app.models.table_models import User
+        client = app.test_client()
+        try:
+            first = client.get('/api/v1/counts')
+            self.assertEqual(first.status_code, 200)
+            etag = first.headers['ETag'].strip('"')
+            self.assertEqual(client.get('/api/v1/counts', headers={'If-None-Match': F'"{etag}"'}).status_code, 304)
+            User(name='Etag', age=1).save()  # invalidates the responses tagged User
+            changed = client.get('/api/v1/counts', headers={'If-None-Match': F'"{etag}"'})
+            self.assertEqual(changed.status_code, 200)
+            self.assertEqual(json.loads(changed.data)['user'], json.loads(first.data)['user'] + 1)
+        finally:
+            User.delete_where([User.name == 'Etag'])
+
+    def test_page_cursor_nullable_order_by(self):
+        from app.api.api import api_endpoint
+        from app.models.table_models import User
+        for age in (None, 3, None, 1, 3):
+            User(name='Keyset', age=age).save()
+        try:
+            rows = User.list_by_query({'name': 'Keyset'})
+            for descending in (False, True):
+                expected = sorted(rows, key=lambda user: (user.age is not None, user.age or 0, user.pid),
+                                  reverse=descending)
+                seen, cursor = [], None
+                while True:
+                    after = api_endpoint.decode_cursor(cursor, User, 'age', descending) if cursor else None
+                    entities, next_after = User.page({'name': 'Keyset'}, after=after, limit=2, order_by='age',
+                                                     descending=descending)
+                    seen += [user.pid for user in entities]
+                    if next_after is None:
+                        break
+                    cursor = api_endpoint.encode_cursor('age', descending, next_after)
+                self.assertEqual(seen, [user.pid for user in expected])
+        finally:
+            User.delete_where([User.name == 'Keyset'])
+
+    def test_export_streams(self):
+        import csv
+        import io
+        import json
+        from app.models.table_models import User_2
+        User_2.bulk_save([{'name_2': 'exported', 'age_2': num} for num in range(3)])
+        client = app.test_client()
+        try:
+            response = client.get('/api/v1/export/user_2?format=ndjson&name_2=exported')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual(sorted(line['age_2'] for line in lines), [0, 1, 2])
+            response = client.get('/api/v1/export/user_2?format=csv&name_2=exported')
+            self.assertEqual(response.mimetype, 'text/csv')
+            rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+            self.assertEqual(sorted(int(row['age_2']) for row in rows), [0, 1, 2])
+            self.assertEqual({row['name_2'] for row in rows}, {'exported'})
+        finally:
+            User_2.delete_where([User_2.name_2 == 'exported'])
+
+    def test_validators_reject_bad_args(self):
+        client = app.test_client()
+        response = client.get('/api/v1/users?limit=0')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'Invalid query args at limit', response.data)
+        response = client.get('/api/v1/users?limit=ten')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'Invalid query args', response.data)
+        response = client.get('/api/v1/users?limit=2')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertIn('X-Validation-Ms', response.headers)